@@ -0,0 +1,55 @@
+"""FLOP reduction vs. measured CPU speedup of block sparse inference.
+
+Usage: python -m benchmarks.block_sparse
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks.utils import print, report
+from modules.pruning import pruning_utils, sparse_export
+from modules.tf_helper import models
+
+
+def get_flops(model, block=None):
+    """Multiply-adds of Dense and Conv2D layers, only nonzero blocks if `block`."""
+
+    flops = 0
+    for layer in model.layers:
+        if not sparse_export.is_exportable(layer, block=True):
+            continue
+        density = sparse_export.get_density(layer, block) if block else 1.0
+        positions = np.prod(layer.output.shape[1:-1], dtype=int)
+        flops += positions * layer.kernel.shape.num_elements() * density
+    return flops
+
+
+def main():
+    pruning_utils.globally_enable_pruning()
+    batch_size = 16
+
+    for block in ((1, 4), (4, 4), (8, 1)):
+        for sparsity in (0.5, 0.8, 0.95):
+            model = models.VGG(input_shape=(32, 32, 3), n_classes=10, version=19)
+            pruning_utils.prune_l1(model, config={'sparsity': sparsity, 'block': block},
+                                   silent=True)
+            pruning_utils.apply_pruning_for_model(model)
+            exported = sparse_export.export_model(model, crossover=1.0, block=block,
+                                                  silent=True)
+
+            dense_time = sparse_export.measure_latency(model, model.input_shape,
+                                                       batch_size=batch_size)
+            sparse_time = sparse_export.measure_latency(exported, exported.input_shape,
+                                                        batch_size=batch_size)
+            flop_reduction = get_flops(model) / get_flops(model, block)
+
+            name = f"VGG19 block={block[0]}x{block[1]} sp={sparsity}"
+            report(f"{name} masked", dense_time)
+            report(f"{name} block sparse", sparse_time)
+            print(f"{name}: FLOPs reduced {flop_reduction:5.2f}x, "
+                  f"wall-clock speedup {dense_time / sparse_time:5.2f}x")
+            tf.keras.backend.clear_session()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""Training batches per second of the CIFAR pipeline, default vs. `fast=True`.
+
+Usage: python -m benchmarks.input_pipeline [data_dir]
+"""
+
+import sys
+import time
+
+from benchmarks.utils import print
+from modules.tf_helper import datasets
+
+
+def get_batches_per_second(ds, steps=400, warmup=400):
+    # warmup longer than an epoch, so the cache is filled before timing
+    iterator = iter(ds)
+    for _ in range(warmup):
+        next(iterator)
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        x, y = next(iterator)
+    x.numpy()
+    return steps / (time.perf_counter() - t0)
+
+
+def main(data_dir=None):
+    results = {}
+    for fast in (False, True):
+        ds = datasets.cifar(data_dir=data_dir, fast=fast)
+        results[fast] = get_batches_per_second(ds['train'])
+        print(f"fast={str(fast):<6} {results[fast]:8.2f} batches/s "
+              f"({results[fast] * 128:8.0f} images/s)")
+    print(f"speedup {results[True] / results[False]:5.2f}x")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
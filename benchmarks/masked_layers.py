@@ -0,0 +1,61 @@
+"""Training steps per second with masked kernels vs. masked gradients.
+
+Usage: python -m benchmarks.masked_layers
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks.utils import print
+from modules.pruning import pruning_utils
+from modules.tf_helper import models, tf_utils, training_functools
+
+
+def get_steps_per_second(model, batch_size=64, steps=20, warmup=3):
+    rng = np.random.default_rng(0)
+    x = tf.constant(rng.random((batch_size, *model.input_shape[1:]), dtype=np.float32))
+    y = tf.constant(rng.integers(0, model.output_shape[-1], batch_size))
+
+    for _ in range(warmup):
+        training_functools.train_step(x, y, model)
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        outs = training_functools.train_step(x, y, model)
+    outs.numpy()
+    return steps / (time.perf_counter() - t0)
+
+
+def build_pruned_model(build_model, mask_gradients, sparsity=0.9):
+    pruning_utils.globally_enable_pruning(mask_gradients=mask_gradients)
+    model = build_model()
+    model.compile(optimizer=tf.keras.optimizers.SGD(0.01, momentum=0.9),
+                  loss=tf_utils.get_loss_fn_from_alias('crossentropy'))
+    pruning_utils.prune_random(model, config={'sparsity': sparsity}, silent=True)
+    pruning_utils.apply_pruning_for_model(model)
+    return model
+
+
+def main():
+    architectures = {
+        'VGG19': lambda: models.VGG(input_shape=(32, 32, 3), n_classes=10, version=19),
+        'ResNet-20': lambda: models.ResNetStiff(input_shape=(32, 32, 3), n_classes=10,
+                                                BLOCKS_IN_GROUP=3),
+    }
+
+    for name, build_model in architectures.items():
+        results = {}
+        for mask_gradients in (False, True):
+            model = build_pruned_model(build_model, mask_gradients)
+            results[mask_gradients] = get_steps_per_second(model)
+
+        print(f"{name:<12} masked kernels {results[False]:8.2f} steps/s, "
+              f"masked gradients {results[True]:8.2f} steps/s, "
+              f"speedup {results[True] / results[False]:5.2f}x")
+
+    pruning_utils.globally_enable_pruning(mask_gradients=False)
+
+
+if __name__ == '__main__':
+    main()
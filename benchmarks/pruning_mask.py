@@ -0,0 +1,66 @@
+"""Global threshold selection: percentile over a flat copy vs. partial selection.
+
+Usage: python -m benchmarks.pruning_mask
+"""
+
+import numpy as np
+
+from benchmarks.utils import measure, print, report
+from modules.pruning import pruning_utils
+from modules.tf_helper import models
+
+
+def get_pruning_mask_percentile(saliences, percentage):
+    """Previous implementation, kept here as the reference point."""
+
+    sizes = [w.size for w in saliences]
+    shapes = [w.shape for w in saliences]
+
+    flatten = np.concatenate([x.flatten() for x in saliences], axis=0)
+    flat_mask = np.ones_like(flatten)
+
+    threshold = np.percentile(flatten, percentage * 100)
+    flat_mask[flatten < threshold] = 0
+
+    cumsizes = np.cumsum(sizes)[:-1]
+    flat_masks = np.split(flat_mask, cumsizes)
+    return [w.reshape(shape) for w, shape in zip(flat_masks, shapes)]
+
+
+def get_kernel_shapes(model):
+    return [tuple(l.kernel.shape) for l in model.layers if hasattr(l, 'kernel')]
+
+
+def main():
+    architectures = {
+        'VGG19': models.VGG(input_shape=(32, 32, 3), n_classes=10, version=19),
+        'WRN-16-8': models.ResNetStiff(input_shape=(32, 32, 3), n_classes=10,
+                                       features=(128, 256, 512), BLOCKS_IN_GROUP=2),
+    }
+    rng = np.random.default_rng(0)
+
+    for name, model in architectures.items():
+        saliences = [np.abs(rng.standard_normal(shape, dtype=np.float32))
+                     for shape in get_kernel_shapes(model)]
+        size = sum(s.size for s in saliences)
+        print(f"{name}: {len(saliences)} kernels, {size} weights, "
+              f"{size * 4 / 2 ** 20:.2f} MB of saliences")
+
+        for sparsity in (0.3, 0.9, 0.99):
+            report(f"{name} sp={sparsity} percentile",
+                   *measure(get_pruning_mask_percentile, saliences, sparsity))
+            report(f"{name} sp={sparsity} selection",
+                   *measure(pruning_utils.get_pruning_mask, saliences, sparsity))
+            report(f"{name} sp={sparsity} selection parallel",
+                   *measure(pruning_utils.get_pruning_mask, saliences, sparsity,
+                            parallel=True))
+
+        report(f"{name} structurize",
+               *measure(pruning_utils.structurize_saliences, dict(enumerate(saliences))))
+        report(f"{name} structurize parallel",
+               *measure(pruning_utils.structurize_saliences, dict(enumerate(saliences)),
+                        parallel=True))
+
+
+if __name__ == '__main__':
+    main()
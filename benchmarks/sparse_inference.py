@@ -0,0 +1,41 @@
+"""CPU latency of masked models vs. models exported with sparse kernels.
+
+Usage: python -m benchmarks.sparse_inference
+"""
+
+import tensorflow as tf
+
+from benchmarks.utils import print, report
+from modules.pruning import pruning_utils, sparse_export, sparse_layers
+from modules.tf_helper import models
+
+
+def main():
+    pruning_utils.globally_enable_pruning()
+    architectures = {
+        'LeNet-300-100': lambda: models.LeNet(input_shape=(28, 28, 1), n_classes=10),
+        'VGG19': lambda: models.VGG(input_shape=(32, 32, 3), n_classes=10, version=19),
+    }
+
+    for name, build_model in architectures.items():
+        for sparsity in (0.9, 0.95, 0.99):
+            model = build_model()
+            pruning_utils.prune_l1(model, config={'sparsity': sparsity}, silent=True)
+            pruning_utils.apply_pruning_for_model(model)
+
+            for batch_size in (1, 64):
+                exported = sparse_export.export_model(model, batch_size=batch_size,
+                                                      silent=True)
+                num_sparse = sum(isinstance(l, sparse_layers.SparseDense)
+                                 for l in exported.layers)
+                print(f"{name} sp={sparsity} batch={batch_size}: "
+                      f"{num_sparse} sparse layers")
+                for label, m in (('masked', model), ('exported', exported)):
+                    seconds = sparse_export.measure_latency(m, m.input_shape,
+                                                            batch_size=batch_size)
+                    report(f"{name} sp={sparsity} bs={batch_size} {label}", seconds)
+            tf.keras.backend.clear_session()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Steps per second of `training_functools.train_epoch` with different metric logging.
+
+Usage: python -m benchmarks.training_loop
+"""
+
+import time
+
+import tensorflow as tf
+from tqdm import tqdm
+
+from benchmarks.utils import print
+from modules.tf_helper import datasets, models, tf_utils, training_functools
+
+LOGGING_MODES = {
+    'every step': {'log_interval': 1},
+    'every 50 steps': {'log_interval': 50},
+    'background': {'log_interval': 1, 'log_in_background': True},
+}
+
+
+def get_steps_per_second(model, dataset, steps=300, **logging):
+    iterator = iter(dataset)
+    pbar = tqdm(disable=True)
+    training_functools.train_epoch(iterator, model, steps=20, use_pbar=pbar, **logging)
+    t0 = time.perf_counter()
+    training_functools.train_epoch(iterator, model, steps=steps, use_pbar=pbar, **logging)
+    return steps / (time.perf_counter() - t0)
+
+
+def main():
+    architectures = {
+        'LeNet-300-100': ('mnist', lambda: models.LeNet(input_shape=(28, 28, 1),
+                                                        n_classes=10)),
+        'ResNet-20': ('cifar10', lambda: models.ResNetStiff(input_shape=(32, 32, 3),
+                                                            n_classes=10,
+                                                            BLOCKS_IN_GROUP=3)),
+    }
+
+    for name, (imitate, build_model) in architectures.items():
+        dataset = datasets.synthetic(imitate=imitate)['train']
+        for mode, logging in LOGGING_MODES.items():
+            model = build_model()
+            model.compile(optimizer=tf.keras.optimizers.SGD(0.01, momentum=0.9),
+                          loss=tf_utils.get_loss_fn_from_alias('crossentropy'),
+                          metrics=['accuracy'])
+            steps_per_second = get_steps_per_second(model, dataset, **logging)
+            print(f"{name:<16} metrics {mode:<16} {steps_per_second:8.2f} steps/s")
+            tf.keras.backend.clear_session()
+
+
+if __name__ == '__main__':
+    main()
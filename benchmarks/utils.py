@@ -0,0 +1,28 @@
+import time
+import tracemalloc
+
+from tools import utils
+
+print = utils.get_cprint(color='cyan')
+
+
+def measure(func, *args, repeats=3, **kwds):
+    """Best wall time and peak of NumPy/Python allocations over `repeats` calls."""
+
+    times = []
+    peaks = []
+    for _ in range(repeats):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        func(*args, **kwds)
+        times.append(time.perf_counter() - t0)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), max(peaks)
+
+
+def report(name, seconds, peak_bytes=None):
+    line = f"{name:<40} {seconds * 1000:10.2f} ms"
+    if peak_bytes is not None:
+        line += f" {peak_bytes / 2 ** 20:10.2f} MB peak"
+    print(line)
@@ -0,0 +1,58 @@
+"""CPU compile time and steady-state step time of masked models with and without XLA.
+
+Usage: python -m benchmarks.xla
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks.utils import print
+from modules.pruning import pruning_utils
+from modules.tf_helper import models, tf_utils, training_functools
+
+
+def time_steps(model, jit_compile, batch_size=64, steps=20):
+    rng = np.random.default_rng(0)
+    x = tf.constant(rng.random((batch_size, *model.input_shape[1:]), dtype=np.float32))
+    y = tf.constant(rng.integers(0, model.output_shape[-1], batch_size))
+    step = training_functools.get_train_step(jit_compile)
+
+    t0 = time.perf_counter()
+    step(x, y, model).numpy()
+    first_step_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        outs = step(x, y, model)
+    outs.numpy()
+    step_time = (time.perf_counter() - t0) / steps
+    return first_step_time - step_time, step_time
+
+
+def main():
+    pruning_utils.globally_enable_pruning()
+    architectures = {
+        'LeNet-300-100': lambda: models.LeNet(input_shape=(28, 28, 1), n_classes=10),
+        'LeNet-5': lambda: models.LeNetConv(input_shape=(28, 28, 1), n_classes=10),
+        'VGG11': lambda: models.VGG(input_shape=(32, 32, 3), n_classes=10, version=11),
+        'ResNet-20': lambda: models.ResNet(dataset='cifar10', version=20),
+        'ResNet-20 stiff': lambda: models.ResNetStiff(dataset='cifar10',
+                                                      BLOCKS_IN_GROUP=3),
+    }
+
+    for name, build_model in architectures.items():
+        for jit_compile in (False, True):
+            model = build_model()
+            model.compile(optimizer=tf.keras.optimizers.SGD(0.01, momentum=0.9),
+                          loss=tf_utils.get_loss_fn_from_alias('crossentropy'))
+            pruning_utils.prune_random(model, config={'sparsity': 0.9}, silent=True)
+            compile_time, step_time = time_steps(model, jit_compile)
+            print(f"{name:<16} jit_compile={str(jit_compile):<6} "
+                  f"compile {compile_time:8.2f} s, step {step_time * 1000:8.2f} ms")
+            tf.keras.backend.clear_session()
+
+
+if __name__ == '__main__':
+    main()
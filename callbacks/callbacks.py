@@ -1,16 +1,44 @@
+import functools
+import math
+
 import tensorflow as tf
 import tqdm
 
 from modules.pruning import pruning_utils
 
 
+def get_pruning_config(density, n_m=None, backend=None):
+    """With `n_m`, target N:M is approached by lowering N as the density decays."""
+
+    if n_m:
+        n, m = n_m
+        n_now = max(n, math.ceil(m * float(density) - 1e-6))
+        return {"n_m": (n_now, m), "backend": backend}
+    return {"sparsity": 1 - density, "backend": backend}
+
+
+def get_required_interval(boundaries):
+    """Largest interval that hits every boundary, they can be floats like `1e4`."""
+
+    steps = []
+    for boundary in boundaries:
+        if int(boundary) != boundary:
+            raise ValueError(f"Boundary {boundary} is not a whole number of steps!")
+        steps.append(int(boundary))
+    return functools.reduce(math.gcd, steps, 0) or 1
+
+
 class CosinePruningCallback(tf.keras.callbacks.Callback):
-    def __init__(self, decay_steps, alpha, interval=100, verbose_interval=2000):
+    def __init__(self, decay_steps, alpha, interval=100, verbose_interval=2000,
+                 backend=None, n_m=None):
         super().__init__()
         self.schedule = tf.keras.experimental.CosineDecay(1.0, decay_steps, alpha)
         self.step = 0
         self.interval = interval
+        self.required_interval = interval
         self.verbose_interval = verbose_interval
+        self.backend = backend
+        self.n_m = n_m
 
     def on_train_batch_begin(self, batch, logs=None):
         if batch % self.interval == 0:
@@ -18,17 +46,19 @@ class CosinePruningCallback(tf.keras.callbacks.Callback):
             density = self.schedule(self.step)
 
             model = pruning_utils.prune_l1(model=self.model,
-                                           config={"sparsity": 1 - density},
+                                           config=get_pruning_config(density, self.n_m,
+                                                                     self.backend),
                                            silent=True)
-            density = pruning_utils.report_density(model, silent=True)
             silent = (self.step % self.verbose_interval) != 0
             if not silent:
+                density = pruning_utils.report_density(model, silent=True)
                 tqdm.tqdm.write(f"REPORTED DENSITY: {density}")
             pruning_utils.apply_pruning_for_model(model)
 
 
 class PolynomialPruningCallback(tf.keras.callbacks.Callback):
-    def __init__(self, decay_steps, alpha, interval=100, verbose_interval=2000):
+    def __init__(self, decay_steps, alpha, interval=100, verbose_interval=2000,
+                 backend=None, n_m=None):
         super().__init__()
         self.schedule = tf.keras.optimizers.schedules.PolynomialDecay(1.0,
                                                                       decay_steps,
@@ -36,7 +66,10 @@ class PolynomialPruningCallback(tf.keras.callbacks.Callback):
                                                                       power=3.0)
         self.step = 0
         self.interval = interval
+        self.required_interval = interval
         self.verbose_interval = verbose_interval
+        self.backend = backend
+        self.n_m = n_m
 
     def on_train_batch_begin(self, batch, logs=None):
         if batch % self.interval == 0:
@@ -45,13 +78,14 @@ class PolynomialPruningCallback(tf.keras.callbacks.Callback):
 
             silent = (self.step % self.verbose_interval) != 0
             model = pruning_utils.prune_l1(model=self.model,
-                                           config={"sparsity": 1 - density},
+                                           config=get_pruning_config(density, self.n_m,
+                                                                     self.backend),
                                            silent=silent)
             pruning_utils.apply_pruning_for_model(model)
 
 
 class PiecewisePruningCallback(tf.keras.callbacks.Callback):
-    def __init__(self, boundaries, values):
+    def __init__(self, boundaries, values, backend=None, n_m=None):
         super().__init__()
         assert len(boundaries) + 1 == len(values)
         self.schedule = tf.keras.optimizers.schedules.PiecewiseConstantDecay(
@@ -59,13 +93,17 @@ class PiecewisePruningCallback(tf.keras.callbacks.Callback):
         )
         self.value = values[0]
         self.step = 0
+        self.required_interval = get_required_interval(boundaries)
+        self.backend = backend
+        self.n_m = n_m
 
     def on_train_batch_begin(self, batch, logs=None):
-        self.step += 1
-        density = self.schedule(self.step)
+        density = self.schedule(self.step + 1)
+        self.step += (logs or {}).get("num_steps", 1)
         if density != self.value:
             self.value = density
             model = pruning_utils.prune_l1(model=self.model,
-                                           config={"sparsity": 1 - density},
+                                           config=get_pruning_config(density, self.n_m,
+                                                                     self.backend),
                                            silent=False)
             pruning_utils.apply_pruning_for_model(model)
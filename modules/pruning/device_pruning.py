@@ -0,0 +1,269 @@
+"""Pruning backend that keeps saliences, threshold and masks on the device.
+
+Mirrors `pruning_utils.get_pruning_mask`: exactly round(sparsity * size) weights
+are pruned and ties are broken by the order of layers and position in a layer.
+"""
+
+import tensorflow as tf
+
+from modules.pruning import sparse_layers
+
+try:
+    from ._initialize import *
+except ImportError:
+    pass
+
+
+def structurize_salience(saliences):
+    shape = saliences.shape
+    if len(shape) == 2:
+        means = tf.reduce_mean(saliences, axis=1, keepdims=True)
+    elif len(shape) == 4:
+        means = tf.reduce_mean(saliences, axis=(0, 1, 2), keepdims=True)
+    else:
+        raise Exception
+    return tf.broadcast_to(means, shape)
+
+
+def structurize_salience_blocks(saliences, block):
+    """Like `pruning_utils.structurize_salience_blocks`."""
+
+    shape = saliences.shape
+    flat = tf.reshape(saliences, (-1, shape[-1]))
+    rows, cols = flat.shape
+    block_rows, block_cols = block
+    paddings = [[0, -rows % block_rows], [0, -cols % block_cols]]
+
+    def block_sums(x):
+        x = tf.pad(x, paddings)
+        x = tf.reshape(x, (x.shape[0] // block_rows, block_rows,
+                           x.shape[1] // block_cols, block_cols))
+        return tf.reduce_sum(x, axis=(1, 3), keepdims=True)
+
+    means = block_sums(flat) / block_sums(tf.ones_like(flat))
+    num_rows, _, num_cols, _ = means.shape
+    means = tf.broadcast_to(means, (num_rows, block_rows, num_cols, block_cols))
+    means = tf.reshape(means, (num_rows * block_rows, num_cols * block_cols))
+    return tf.reshape(means[:rows, :cols], shape)
+
+
+def count_nonzero(flats, condition):
+    return tf.add_n([tf.math.count_nonzero(condition(f)) for f in flats])
+
+
+def find_kth_smallest(flats, k, sample_size=2 ** 16):
+    """
+    :param flats: list of 1-D salience tensors
+    :param k: int64 scalar tensor, 0-indexed rank of the value to find
+    :param sample_size: size of random sample used to bracket the answer
+    :return: value of the `k`-th smallest salience
+    """
+    total = sum(f.shape.num_elements() for f in flats)
+    if total <= sample_size:
+        return tf.gather(tf.sort(tf.concat(flats, 0)), k)
+
+    samples = []
+    for idx, f in enumerate(flats):
+        size = f.shape.num_elements()
+        if num := size * sample_size // total:
+            positions = tf.random.stateless_uniform([num], seed=[idx, 0], minval=0,
+                                                    maxval=size, dtype=tf.int64)
+            samples.append(tf.gather(f, positions))
+    sample = tf.sort(tf.concat(samples, 0))
+    num_samples = sample.shape.num_elements()
+
+    position = tf.cast(k, tf.float64) * num_samples / total
+    margin = 4 * num_samples ** 0.5
+    lo_idx = tf.cast(position - margin, tf.int64)
+    hi_idx = tf.cast(position + margin, tf.int64)
+
+    smallest = tf.reduce_min([tf.reduce_min(f) for f in flats])
+    largest = tf.reduce_max([tf.reduce_max(f) for f in flats])
+    lo = tf.where(lo_idx > 0, tf.gather(sample, tf.maximum(lo_idx, 0)), smallest)
+    hi = tf.where(hi_idx < num_samples - 1,
+                  tf.gather(sample, tf.minimum(hi_idx, num_samples - 1)), largest)
+    below = count_nonzero(flats, lambda f: f < lo)
+    upto = count_nonzero(flats, lambda f: f <= hi)
+
+    # rare: the sample was unlucky, bracket everything instead
+    missed = tf.logical_not((below <= k) & (k < upto))
+    lo = tf.where(missed, smallest, lo)
+    hi = tf.where(missed, largest, hi)
+    below = tf.where(missed, tf.zeros_like(below), below)
+
+    k = k - below
+    num_lo = count_nonzero(flats, lambda f: tf.equal(f, lo))
+    inside = tf.concat([tf.boolean_mask(f, (f > lo) & (f < hi)) for f in flats], 0)
+
+    def select_inside():
+        return tf.gather(tf.sort(inside), k - num_lo)
+
+    def select_above_lo():
+        return tf.cond(k - num_lo < tf.size(inside, out_type=tf.int64),
+                       select_inside, lambda: hi)
+
+    return tf.cond(k < num_lo, lambda: lo, select_above_lo)
+
+
+def get_pruning_masks(saliences, sparsity):
+    """
+    :param saliences: list of saliences tensors
+    :param sparsity: scalar tensor, exactly round(sparsity * size) weights are pruned
+    :return: list of boolean masks, True for weights that are kept
+    """
+    flats = [tf.reshape(s, [-1]) for s in saliences]
+    total = sum(f.shape.num_elements() for f in flats)
+
+    num_pruned = tf.cast(tf.round(tf.cast(sparsity, tf.float64) * total), tf.int64)
+    num_pruned = tf.clip_by_value(num_pruned, 0, total)
+    threshold = find_kth_smallest(flats, tf.minimum(num_pruned, total - 1))
+    num_ties = num_pruned - count_nonzero(flats, lambda f: f < threshold)
+
+    masks = []
+    for s, f in zip(saliences, flats):
+        ties = tf.equal(f, threshold)
+        tie_rank = tf.cumsum(tf.cast(ties, tf.int64), exclusive=True)
+        pruned = (f < threshold) | (ties & (tie_rank < num_ties))
+        num_ties -= tf.math.count_nonzero(ties)
+        masks.append(tf.reshape(tf.logical_not(pruned), s.shape))
+    return masks
+
+
+def get_budget_masks(saliences, costs, budget):
+    """
+    :param saliences: list of saliences tensors
+    :param costs: float64 tensor with the cost of a single weight of every tensor
+    :param budget: scalar tensor, fraction of the total cost that remains
+    :return: list of boolean masks like in `pruning_utils.saliences2masks_budget`
+    """
+    costs = tf.unstack(tf.cast(costs, tf.float64), num=len(saliences))
+    smallest = tf.reduce_min([tf.reduce_min(s) for s in saliences])
+    scores = [(tf.reshape(s, [-1]) - smallest) / tf.cast(c, s.dtype)
+              for s, c in zip(saliences, costs)]
+    total = sum(f.shape.num_elements() for f in scores)
+
+    order = tf.argsort(tf.concat(scores, 0), stable=True)
+    flat_costs = tf.concat([tf.fill(f.shape, c) for f, c in zip(scores, costs)], 0)
+    cumulative_cost = tf.cumsum(tf.gather(flat_costs, order))
+    del order, flat_costs
+
+    cost_to_prune = (1 - tf.cast(budget, tf.float64)) * cumulative_cost[-1]
+    num_pruned = tf.searchsorted(cumulative_cost, [cost_to_prune], out_type=tf.int64)[0]
+    num_pruned = tf.where(cost_to_prune > 0, tf.minimum(num_pruned + 1, total),
+                          tf.zeros_like(num_pruned))
+    return get_pruning_masks(scores, tf.cast(num_pruned, tf.float64) / total)
+
+
+def get_n_m_mask(saliences, n, m):
+    """Like `pruning_utils.get_n_m_mask`, `top_k` also prefers lower positions."""
+
+    rank = len(saliences.shape)
+    swap = list(range(rank - 2)) + [rank - 1, rank - 2]
+    s = tf.transpose(saliences, swap)
+    size = s.shape[-1]
+    s = tf.pad(s, [[0, 0]] * (rank - 1) + [[0, -size % m]], constant_values=-float('inf'))
+    groups = tf.reshape(s, (*s.shape[:-1], -1, m))
+
+    _, kept = tf.math.top_k(groups, k=n)
+    mask = tf.reduce_any(tf.cast(tf.one_hot(kept, m), tf.bool), axis=-2)
+    mask = tf.reshape(mask, s.shape)[..., :size]
+    return tf.transpose(mask, swap)
+
+
+def get_saliences(kernels, masks, method):
+    if method == 'magnitude':
+        return [tf.abs(kernel) for kernel in kernels]
+    elif method == 'random':
+        return [tf.random.uniform(kernel.shape) for kernel in kernels]
+    elif method == 'kernel mask':
+        return [tf.cast(mask, tf.float32) for mask in masks]
+    else:
+        raise KeyError(f"PRUNING {method} is unknown!")
+
+
+@tf.function
+def update_kernel_masks(kernels, masks, sparsity, method, structure=False, block=None,
+                        n_m=None, costs=None, counters=None):
+    """
+    :param kernels: list of kernel variables
+    :param masks: list of kernel mask variables, updated in place
+    :param sparsity: float64 scalar tensor, a tensor to avoid retracing
+    :param method: 'magnitude', 'random' or 'kernel mask'
+    :param structure: if True, saliences are averaged like in `structurize_salience`
+    :param block: if given, saliences are averaged in blocks of this shape
+    :param n_m: if given, N out of every M input weights are kept, `sparsity` is ignored
+    :param costs: if given, float64 tensor with the cost of a single weight in every
+                  kernel and `sparsity` is the fraction of the total cost that is pruned
+    :param counters: if given, variables set to number of unpruned weights in masks
+    :return: None
+    """
+    saliences = get_saliences(kernels, masks, method)
+    saliences = [tf.cast(s, tf.float32) for s in saliences]
+    if structure:
+        saliences = [structurize_salience(s) for s in saliences]
+    if block:
+        saliences = [structurize_salience_blocks(s, block) for s in saliences]
+
+    if n_m:
+        new_masks = [get_n_m_mask(s, *n_m) for s in saliences]
+    elif costs is not None:
+        new_masks = get_budget_masks(saliences, costs, 1 - sparsity)
+    else:
+        new_masks = get_pruning_masks(saliences, sparsity)
+    for mask, new_mask in zip(masks, new_masks):
+        mask.assign(tf.cast(new_mask, mask.dtype))
+    for counter, new_mask in zip(counters or (), new_masks):
+        counter.assign(tf.math.count_nonzero(new_mask, dtype=counter.dtype))
+
+
+def prune(model, config, method, silent=False, costs=None):
+    """
+    :param costs: with `flops` or `latency` budget in `config`, dict with costs of a
+                  single weight from `pruning_utils.get_kernel_costs`
+    """
+    budgets = [key for key in ('flops', 'latency') if config.get(key)]
+    if budgets:
+        assert costs is not None, "Costs are required with a budget!"
+        sparsity = 1 - config[budgets[0]]
+    else:
+        sparsity = config.get('sparsity') or 0.0
+    structure = bool(config.get('structure'))
+    block = tuple(config['block']) if config.get('block') else None
+    n_m = tuple(config['n_m']) if config.get('n_m') else None
+
+    layers = sparse_layers.get_masked_layers(model)
+    update_kernel_masks([layer.kernel for layer in layers],
+                        [layer.kernel_mask for layer in layers],
+                        tf.cast(sparsity, tf.float64),
+                        method=method,
+                        structure=structure,
+                        block=block,
+                        n_m=n_m,
+                        costs=tf.constant([costs[layer.kernel.name] for layer in layers],
+                                          tf.float64) if budgets else None,
+                        counters=[layer.nonzero for layer in layers])
+    if not silent:
+        counts = sparse_layers.count_nonzero(layers)
+        for layer, nonzero in zip(layers, counts):
+            sparsity = 1 - nonzero / layer.kernel_mask.shape.num_elements()
+            print(f"{layer.kernel.name:<32} pruning to "
+                  f"{sparsity * 100:6.2f}%"
+                  f" (left {nonzero})")
+        if budgets:
+            remaining = sum(costs[l.kernel.name] * c for l, c in zip(layers, counts))
+            total = sum(costs[l.kernel.name] * l.kernel_mask.shape.num_elements()
+                        for l in layers)
+            print(f"REMAINING {budgets[0].upper()}: {remaining / total * 100:6.2f}%")
+    return model
+
+
+def prune_l1(model, config, silent=False, costs=None):
+    return prune(model, config, method='magnitude', silent=silent, costs=costs)
+
+
+def prune_random(model, config, silent=False, costs=None):
+    return prune(model, config, method='random', silent=silent, costs=costs)
+
+
+def prune_by_kernel_masks(model, config, silent=False, costs=None):
+    return prune(model, config, method='kernel mask', silent=silent, costs=costs)
@@ -0,0 +1,107 @@
+"""Packed storage of N:M sparse kernels: only kept values and their in-group positions.
+
+Layout of the packed kernel of shape (..., inputs, outputs) is (..., outputs,
+groups, N), groups are `M` consecutive input channels. Positions are `uint8`.
+If a group has less than N kept weights, the rest of its positions are set to M.
+"""
+
+import numpy as np
+
+from modules.pruning import sparse_layers
+
+try:
+    from ._initialize import *
+except ImportError:
+    pass
+
+
+def to_groups(x, m, fill=0):
+    x = np.moveaxis(x, -2, -1)
+    x = np.pad(x, [(0, 0)] * (x.ndim - 1) + [(0, -x.shape[-1] % m)], constant_values=fill)
+    return x.reshape(*x.shape[:-1], -1, m)
+
+
+def pack_kernel(kernel, mask, n_m):
+    """
+    :param kernel: NumPy kernel of Dense or Conv2D
+    :param mask: mask of the kernel with at most N nonzeros in every group of M
+    :param n_m: pair (N, M)
+    :return: packed values and positions
+    """
+    n, m = n_m
+    assert m < 256, "Positions are stored as uint8!"
+    kernel_groups = to_groups(kernel, m)
+    mask_groups = to_groups(mask.astype(bool), m, fill=False)
+    assert mask_groups.sum(axis=-1).max() <= n, f"Mask is not {n}:{m} sparse!"
+
+    # kept positions go first, in order
+    positions = np.argsort(~mask_groups, axis=-1, kind='stable')[..., :n]
+    is_kept = np.take_along_axis(mask_groups, positions, axis=-1)
+    values = np.where(is_kept, np.take_along_axis(kernel_groups, positions, axis=-1), 0)
+    positions = np.where(is_kept, positions, m).astype(np.uint8)
+    return values.astype(kernel.dtype), positions
+
+
+def unpack_kernel(values, positions, shape, m):
+    """
+    :param values: packed values from `pack_kernel`
+    :param positions: packed positions from `pack_kernel`
+    :param shape: shape of the kernel
+    :param m: size of groups
+    :return: kernel and its boolean mask
+    """
+    # additional position M collects the unused entries
+    groups = np.zeros((*values.shape[:-1], m + 1), dtype=values.dtype)
+    np.put_along_axis(groups, positions.astype(np.int64), values, axis=-1)
+    mask = np.zeros(groups.shape, dtype=bool)
+    np.put_along_axis(mask, positions.astype(np.int64), True, axis=-1)
+
+    def from_groups(x):
+        x = x[..., :m].reshape(*x.shape[:-2], -1)[..., :shape[-2]]
+        return np.moveaxis(x, -1, -2)
+
+    return from_groups(groups), from_groups(mask)
+
+
+def save_packed_weights(model, path, n_m):
+    """
+    :param model: model with N:M pruned masked layers
+    :param path: path of `.npz` file
+    :param n_m: pair (N, M)
+    :return: None
+
+    Kernels of masked layers are packed and their masks aren't saved at all,
+    other weights are saved as they are.
+    """
+    packed = {}
+    masked_kernels = {l.kernel.name: l for l in sparse_layers.get_masked_layers(model)}
+    for idx, w in enumerate(model.weights):
+        if w.name in masked_kernels:
+            mask = masked_kernels[w.name].kernel_mask.numpy()
+            packed[f'{idx}.values'], packed[f'{idx}.positions'] = pack_kernel(
+                w.numpy(), mask, n_m)
+        elif 'kernel_mask' not in w.name:
+            packed[str(idx)] = w.numpy()
+    np.savez(path, n_m=np.array(n_m), **packed)
+    print(f"SAVED {len(masked_kernels)} PACKED KERNELS TO {path}")
+
+
+def load_packed_weights(model, path):
+    """
+    :param model: model of the same architecture as in `save_packed_weights`
+    :param path: path of `.npz` file
+    :return: None
+    """
+    packed = np.load(path)
+    _, m = packed['n_m']
+    masked_layers = {l.kernel.name: l for l in sparse_layers.get_masked_layers(model)}
+    for idx, w in enumerate(model.weights):
+        if w.name in masked_layers:
+            kernel, mask = unpack_kernel(packed[f'{idx}.values'],
+                                         packed[f'{idx}.positions'],
+                                         w.shape, m)
+            w.assign(kernel)
+            masked_layers[w.name].set_pruning_mask(mask)
+        elif 'kernel_mask' not in w.name:
+            w.assign(packed[str(idx)])
+    print(f"LOADED {len(masked_layers)} PACKED KERNELS FROM {path}")
@@ -1,7 +1,7 @@
 import tensorflow as tf
 
 from modules import tf_helper
-from modules.pruning import pruning_utils
+from modules.pruning import pruning_utils, sparse_layers
 from modules.tf_helper import datasets, models, tf_utils, training_functools
 
 try:
@@ -55,18 +55,24 @@ def main(exp):
     if lr_metric:
         metrics.append(lr_metric)
 
-    model.compile(optimizer, loss_fn, metrics=metrics)
+    jit_compile = hasattr(exp, 'jit_compile') and exp.jit_compile
+    compile_kwds = {'jit_compile': True} if jit_compile else {}
+    model.compile(optimizer, loss_fn, metrics=metrics, **compile_kwds)
     tf_utils.print_model_info(model)
 
     # load checkpointed all weights before the pruning
+    checkpoint = None
     if hasattr(exp, 'load_model_before_pruning') and exp.load_model_before_pruning:
-        model.load_weights(exp.load_model_before_pruning)
-        print(f"LOADED BEFORE PRUNING {exp.load_model_before_pruning}")
+        checkpoint = exp.load_model_before_pruning
+        model.load_weights(checkpoint)
+        sparse_layers.count_masks(model)
+        print(f"LOADED BEFORE PRUNING {checkpoint}")
 
     model = pruning_utils.set_pruning_masks(model=model,
                                             pruning_method=exp.pruning,
                                             pruning_config=exp.pruning_config,
-                                            dataset=dataset)
+                                            dataset=dataset,
+                                            checkpoint=checkpoint)
     assert isinstance(model, tf.keras.Model)
 
     # load or reset weights after the pruning, do not change masks
@@ -114,7 +120,8 @@ def main(exp):
 
     checkpoint_callback.set_model(model)
     checkpoint_callback.on_epoch_end(epoch=-1)  # for checkpointing before training
-    callbacks = [checkpoint_callback]
+    step_timer = tf_utils.StepTimer()
+    callbacks = [checkpoint_callback, step_timer]
 
     if hasattr(exp, 'callback'):
         exp.callback.set_model(model)
@@ -122,6 +129,14 @@ def main(exp):
 
     if num_epochs > initial_epoch:
         if hasattr(exp, 'custom_training') and exp['custom_training']:
+            log_interval = 1
+            if hasattr(exp, 'log_interval') and exp.log_interval:
+                log_interval = exp.log_interval
+            log_in_background = (hasattr(exp, 'log_in_background')
+                                 and exp.log_in_background)
+            steps_per_execution = 1
+            if hasattr(exp, 'steps_per_execution') and exp.steps_per_execution:
+                steps_per_execution = exp.steps_per_execution
             history = training_functools.fit(
                 model=model,
                 training_data=dataset['train'],
@@ -130,6 +145,10 @@ def main(exp):
                 epochs=num_epochs,
                 initial_epoch=initial_epoch,
                 callbacks=callbacks,
+                log_interval=log_interval,
+                log_in_background=log_in_background,
+                steps_per_execution=steps_per_execution,
+                jit_compile=jit_compile,
             )
         else:
             history = model.fit(x=dataset['train'],
@@ -139,8 +158,20 @@ def main(exp):
                                 initial_epoch=initial_epoch,
                                 callbacks=callbacks).history
 
+        exp.COMPILE_TIME = step_timer.compile_time
+        exp.STEP_TIME = step_timer.step_time
+        print(f"COMPILE TIME: {exp.COMPILE_TIME}, STEP TIME: {exp.STEP_TIME}")
+
         exp.FINAL_DENSITY = pruning_utils.report_density(model)
         print("FINAL DENSITY:", exp.FINAL_DENSITY)
+
+        profile_batch_size = 1
+        if hasattr(exp, 'profile_batch_size') and exp.profile_batch_size:
+            profile_batch_size = exp.profile_batch_size
+        totals = tf_utils.print_model_profile(model, batch_size=profile_batch_size)
+        exp.DENSE_FLOPS = totals['dense_flops']
+        exp.SPARSE_FLOPS = totals['sparse_flops']
+        exp.ACTIVATION_BYTES = totals['activation_bytes']
         tf_utils.log_from_history(history, exp=exp)
     checkpoint_callback.list_created_checkpoints()
 
@@ -1,8 +1,10 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import tensorflow as tf
 
-from modules.pruning import sparse_layers
-from modules.tf_helper import tf_utils
+from modules.pruning import device_pruning, salience_cache, sparse_export, sparse_layers
 
 try:
     from ._initialize import *
@@ -10,14 +12,50 @@ except ImportError:
     pass
 
 
-def globally_enable_pruning():
+def globally_enable_pruning(mask_dtype=None, mask_gradients=None):
+    """
+    :param mask_dtype: dtype of `kernel_mask` weights, `bool` by default
+    :param mask_gradients: if True, layers skip multiplying kernels by masks in the
+                           forward pass and mask gradients instead, see `sparse_layers`
+    :return: None
+    """
+    for layer_class in (sparse_layers.MaskedDense, sparse_layers.MaskedConv):
+        if mask_dtype:
+            layer_class.mask_dtype = mask_dtype
+        if mask_gradients is not None:
+            layer_class.mask_gradients = bool(mask_gradients)
     tf.keras.layers.Dense = sparse_layers.MaskedDense
     tf.keras.layers.Conv2D = sparse_layers.MaskedConv
     print("PRUNING IS ENABLED GLOBALLY! LAYERS HAVE BEEN REPLACED...")
 
 
-def structurize_saliences(saliences):
-    return {k: structurize_salience(v) for k, v in saliences.items()}
+_thread_pool = None
+
+
+def get_thread_pool():
+    """Thread pool sized to the host, shared by all parallel per-layer work."""
+
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+    return _thread_pool
+
+
+def map_layers(func, *iterables, parallel=False):
+    """
+    :param func: function applied to every layer, NumPy releases GIL in most of them
+    :param iterables: per-layer arguments of `func`, like in `map`
+    :param parallel: if True, layers are processed by `get_thread_pool`
+    :return: list of results in the order of layers
+    """
+    if parallel:
+        return list(get_thread_pool().map(func, *iterables))
+    return list(map(func, *iterables))
+
+
+def structurize_saliences(saliences, parallel=False):
+    structurized = map_layers(structurize_salience, saliences.values(), parallel=parallel)
+    return {k: v for k, v in zip(saliences, structurized)}
 
 
 def structurize_salience(saliences):
@@ -51,215 +89,683 @@ def structurize_salience_conv(saliences):
     return np.reshape(saliences, shape)
 
 
-def snip_saliences(model, loader, batches=1):
+def structurize_salience_blocks(saliences, block):
+    """
+    :param saliences: saliences of Dense or Conv2D kernel
+    :param block: (rows, columns) of a block in the kernel reshaped to 2D
+    :return: saliences averaged in blocks, blocks on the edges can be smaller
+
+    Kernel is reshaped to (inputs, outputs) like in the im2col convolution, so
+    rows of a Conv2D block are consecutive input channels at the same position.
+    """
+    shape = saliences.shape
+    flat = saliences.reshape(-1, shape[-1])
+    block_rows, block_cols = block
+    rows = np.arange(0, flat.shape[0], block_rows)
+    cols = np.arange(0, flat.shape[1], block_cols)
+
+    sums = np.add.reduceat(np.add.reduceat(flat, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(rows, append=flat.shape[0]),
+                      np.diff(cols, append=flat.shape[1]))
+    means = (sums / counts).astype(saliences.dtype)
+    means = np.repeat(means, block_rows, axis=0)[:flat.shape[0]]
+    means = np.repeat(means, block_cols, axis=1)[:, :flat.shape[1]]
+    return means.reshape(shape)
+
+
+def get_maskable_kernels(model):
+    """Kernels of layers with `kernel_mask`, the only weights that get saliences."""
+
+    return [layer.kernel for layer in sparse_layers.get_masked_layers(model)]
+
+
+def get_calibration_batches(loader, batches=1, micro_batch_size=None):
     """
-    :param model: callable model with trainable_weights
     :param loader: `tf.data.Dataset` with `.take` method
     :param batches: int, number of batches to take with `.take` method
-    :return: dict, keys are Variable name, values are saliences from SNIP
+    :param micro_batch_size: if given, taken examples are re-batched to this size
+    :return: `tf.data.Dataset` with calibration batches
+    """
+    loader = loader.take(batches)
+    if micro_batch_size:
+        loader = loader.unbatch().batch(micro_batch_size)
+    return loader
+
+
+def sum_over_shards(func, x, y, devices=None):
+    """
+    :param func: function of `(x, y)` returning list of tensors
+    :param devices: if given, batch is split between them and results are summed
+    :return: list of tensors returned by `func`, summed over shards
+    """
+    if not devices:
+        return func(x, y)
+
+    size = tf.shape(x)[0]
+    results = []
+    for idx, device in enumerate(devices):
+        start = size * idx // len(devices)
+        stop = size * (idx + 1) // len(devices)
+        with tf.device(device):
+            results.append(func(x[start:stop], y[start:stop]))
+    return [tf.add_n(list(shards)) for shards in zip(*results)]
+
+
+def accumulate_over_batches(func, loader, kernels, devices=None):
+    """
+    :param func: function of `(x, y)` returning one tensor for every kernel
+    :param loader: `tf.data.Dataset`, e.g. from `get_calibration_batches`
+    :param kernels: list of variables, results are preallocated with their shapes
+    :param devices: if given, every batch is sharded between these devices
+    :return: list of variables with results of `func` summed over all batches
     """
-    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-    cumulative_grads = [tf.zeros_like(w) for w in model.trainable_weights]
+    cumulative = [tf.Variable(tf.zeros_like(w), trainable=False) for w in kernels]
 
-    for x, y in loader.take(batches):
-        with tf.GradientTape() as tape:
+    @tf.function
+    def accumulate(dataset):
+        for x, y in dataset:
+            results = sum_over_shards(func, x, y, devices=devices)
+            for c, r in zip(cumulative, results):
+                c.assign_add(r)
+
+    accumulate(loader)
+    return cumulative
+
+
+def get_gradients_fn(model, kernels, loss_fn):
+    """Returns function of `(x, y)` computing gradients of `loss_fn` w.r.t. `kernels`."""
+
+    def compute_gradients(x, y):
+        with tf.GradientTape(watch_accessed_variables=False) as tape:
+            tape.watch(kernels)
             outs = model(x)
             outs = tf.cast(outs, tf.float32)
             loss = loss_fn(y, outs)
-        grads = tape.gradient(loss, model.trainable_weights)
-        cumulative_grads = [c + g for c, g in zip(cumulative_grads, grads)]
+        return tape.gradient(loss, kernels)
+
+    return compute_gradients
+
+
+def accumulate_gradients(model, loader, kernels, devices=None):
+    """
+    :param model: callable model with masked layers
+    :param loader: `tf.data.Dataset`, e.g. from `get_calibration_batches`
+    :param kernels: list of variables to differentiate the loss with respect to
+    :param devices: if given, every batch is sharded between these devices
+    :return: list of gradients of the loss summed over all examples in `loader`
+    """
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.SUM)
+    compute_gradients = get_gradients_fn(model, kernels, loss_fn)
+    return accumulate_over_batches(compute_gradients, loader, kernels, devices=devices)
+
+
+def count_examples(loader):
+    """Number of examples in `loader`, as a float32 tensor."""
+
+    num_examples = loader.reduce(tf.constant(0, tf.int64),
+                                 lambda n, batch: n + tf.shape(batch[0], tf.int64)[0])
+    return tf.cast(num_examples, tf.float32)
+
+
+def accumulate_hessian_gradient(model, loader, kernels, devices=None, mode='hvp'):
+    """
+    :param model: callable model with masked layers
+    :param loader: `tf.data.Dataset`, e.g. from `get_calibration_batches`, it's
+                   iterated many times, so it has to give the same examples
+    :param kernels: list of variables, both H and g are taken with respect to them
+    :param devices: if given, every batch is sharded between these devices
+    :param mode: 'hvp' for forward-over-reverse Hessian-vector product,
+                 'double_tape' for differentiating `g * stop_gradient(g)` layer by layer
+    :return: list of Hessian-gradient products `Hg` of the mean loss over `loader`
+
+    `Hg` is quadratic in the examples, so `g` of the whole calibration set is
+    accumulated first and then `H` of every shard is multiplied by this fixed `g`.
+    The result doesn't depend on how examples are split into batches and shards.
+    """
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.SUM)
+    compute_gradients = get_gradients_fn(model, kernels, loss_fn)
+
+    num_examples = count_examples(loader)
+    grads = accumulate_over_batches(compute_gradients, loader, kernels, devices=devices)
+    grads = [g / num_examples for g in grads]
+
+    def hvp(x, y):
+        with tf.autodiff.ForwardAccumulator(primals=kernels, tangents=grads) as acc:
+            shard_grads = compute_gradients(x, y)
+        return acc.jvp(shard_grads, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+    def double_tape(x, y):
+        with tf.GradientTape(watch_accessed_variables=False) as tape:
+            tape.watch(kernels)
+            shard_grads = compute_gradients(x, y)
+            g_dot_g = tf.add_n([tf.reduce_sum(sg * g)
+                                for sg, g in zip(shard_grads, grads)])
+        return tape.gradient(g_dot_g, kernels)
+
+    if mode == 'hvp':
+        func = hvp
+    elif mode == 'double_tape':
+        func = double_tape
+    else:
+        raise KeyError(f"GraSP mode {mode} is unknown!")
+    cumulative_hg = accumulate_over_batches(func, loader, kernels, devices=devices)
+    return [hg / num_examples for hg in cumulative_hg]
+
+
+def snip_saliences(model, loader, batches=1, micro_batch_size=None, devices=None):
+    """
+    :param model: callable model with masked layers
+    :param loader: `tf.data.Dataset` with `.take` method
+    :param batches: int, number of batches to take with `.take` method
+    :param micro_batch_size: if given, gradients are computed for this many examples
+    :param devices: if given, every micro-batch is sharded between these devices
+    :return: dict, keys are kernel names, values are saliences from SNIP
+    """
+    kernels = get_maskable_kernels(model)
+    loader = get_calibration_batches(loader, batches, micro_batch_size)
+    cumulative_grads = accumulate_gradients(model, loader, kernels, devices=devices)
     saliences = {w.name: tf.abs(w * g).numpy() for w, g in
-                 zip(model.trainable_weights, cumulative_grads)}
+                 zip(kernels, cumulative_grads)}
     return saliences
 
 
 def psuedo_snip_saliences(model, *args, **kwds):
     """
-    :param model: callable model with trainable_weights
-    :return: dict, keys are Variable name, values are saliences from SNIP
+    :param model: callable model with masked layers
+    :return: dict, keys are kernel names, values are saliences from SNIP
     """
+    kernels = get_maskable_kernels(model)
     cumulative_grads = [tf.random.uniform(shape=w.shape, minval=-1, maxval=1) for w in
-                        model.trainable_weights]
+                        kernels]
     saliences = {w.name: tf.abs(w * g).numpy() for w, g in
-                 zip(model.trainable_weights, cumulative_grads)}
+                 zip(kernels, cumulative_grads)}
     return saliences
 
 
-def grasp_saliences(model, loader, batches=1):
+def grasp_saliences(model, loader, batches=1, micro_batch_size=None, devices=None,
+                    mode='hvp', sign=-1):
     """
-    :param model: callable model with trainable_weights
+    :param model: callable model with masked layers
     :param loader: `tf.data.Dataset` with `.take` method
     :param batches: int, number of batches to take with `.take` method
-    :return: dict, keys are Variable name, values are saliences from GraSP
-    """
-    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-    cumulative_grads = [tf.zeros_like(w) for w in model.trainable_weights]
-
-    for x, y in loader.take(batches):
-        with tf.GradientTape() as tape:
-            with tf.GradientTape() as tape2:
-                outs = model(x)
-                outs = tf.cast(outs, tf.float32)
-                loss = loss_fn(y, outs)
-            g1 = tape2.gradient(loss, model.trainable_weights)
-            g1 = tf.concat([tf.reshape(g, -1) for g in g1], 0)
-            g1 = tf.reduce_sum(g1 * tf.stop_gradient(g1))
-        g2 = tape.gradient(g1, model.trainable_weights)
-        cumulative_grads = [c + g for c, g in zip(cumulative_grads, g2)]
-
-    saliences = {w.name: -(w * g).numpy() for w, g in
-                 zip(model.trainable_weights, cumulative_grads)}
+    :param micro_batch_size: if given, `Hg` is computed for this many examples
+    :param devices: if given, every micro-batch is sharded between these devices
+    :param mode: 'hvp' or 'double_tape', see `accumulate_hessian_gradient`
+    :param sign: -1 for GraSP, 1 for minus GraSP
+    :return: dict, keys are kernel names, values are saliences from GraSP
+
+    Saliences are computed for the mean loss over all taken examples, calibration
+    batches are cached so every pass over them sees the same examples.
+    """
+    kernels = get_maskable_kernels(model)
+    loader = get_calibration_batches(loader, batches, micro_batch_size).cache()
+    cumulative_hg = accumulate_hessian_gradient(model, loader, kernels,
+                                                devices=devices, mode=mode)
+    saliences = {w.name: (sign * w * g).numpy() for w, g in
+                 zip(kernels, cumulative_hg)}
     return saliences
 
 
-def minus_grasp_saliences(model, loader, batches=1):
+def minus_grasp_saliences(model, loader, batches=1, **kwds):
     """
-    :param model: callable model with trainable_weights
+    :param model: callable model with masked layers
     :param loader: `tf.data.Dataset` with `.take` method
     :param batches: int, number of batches to take with `.take` method
-    :return: dict, keys are Variable name, values are saliences from GraSP
-    """
-    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-    cumulative_grads = [tf.zeros_like(w) for w in model.trainable_weights]
-
-    for x, y in loader.take(batches):
-        with tf.GradientTape() as tape:
-            with tf.GradientTape() as tape2:
-                outs = model(x)
-                outs = tf.cast(outs, tf.float32)
-                loss = loss_fn(y, outs)
-            g1 = tape2.gradient(loss, model.trainable_weights)
-            g1 = tf.concat([tf.reshape(g, -1) for g in g1], 0)
-            g1 = tf.reduce_sum(g1 * tf.stop_gradient(g1))
-        g2 = tape.gradient(g1, model.trainable_weights)
-        cumulative_grads = [c + g for c, g in zip(cumulative_grads, g2)]
-
-    saliences = {w.name: (w * g).numpy() for w, g in
-                 zip(model.trainable_weights, cumulative_grads)}
-    return saliences
+    :return: dict, keys are kernel names, values are saliences from GraSP
+    """
+    return grasp_saliences(model, loader, batches, sign=1, **kwds)
 
 
-def get_pruning_mask(saliences, percentage):
+def find_kth_smallest(saliences, k, sample_size=2 ** 16, parallel=False):
     """
     :param saliences: list of saliences arrays
-    :param percentage: at most this many percentage of weights will be zeroed
-    :return: list of masks of 1's and 0's with corresponding sizes
+    :param k: int, 0-indexed rank of the value to find among all saliences
+    :param sample_size: size of random sample used to bracket the answer
+    :param parallel: if True, per-layer counting is spread over `get_thread_pool`
+    :return: value of the `k`-th smallest salience
+
+    Never builds a flat copy of all saliences. A small random sample brackets
+    the answer, then only the values inside the bracket are partitioned.
     """
-    sizes = [w.size for w in saliences]
-    shapes = [w.shape for w in saliences]
+    total = sum(s.size for s in saliences)
+    assert 0 <= k < total, f"k={k} is out of range for {total} saliences!"
+    flats = [s.reshape(-1) for s in saliences]
+
+    def count(condition):
+        counts = map_layers(lambda f: np.count_nonzero(condition(f)), flats,
+                            parallel=parallel)
+        return sum(counts)
+
+    if total <= sample_size:
+        return np.partition(np.concatenate(flats), k)[k]
+
+    rng = np.random.default_rng(0)
+    sample = np.concatenate([f[rng.integers(0, f.size, f.size * sample_size // total)]
+                             for f in flats])
+    sample.sort()
+    position = k * sample.size / total
+    margin = 4 * np.sqrt(sample.size)
+
+    while True:
+        lo_idx = int(position - margin)
+        hi_idx = int(position + margin)
+        if lo_idx > 0:
+            lo = sample[lo_idx]
+            below = count(lambda f: f < lo)
+        else:
+            lo = min(f.min() for f in flats)
+            below = 0
+        if hi_idx < sample.size - 1:
+            hi = sample[hi_idx]
+            upto = count(lambda f: f <= hi)
+        else:
+            hi = max(f.max() for f in flats)
+            upto = total
+
+        if below <= k < upto:
+            break
+        margin *= 4  # rare: the sample was unlucky, widen the bracket
+
+    k -= below
+    num_lo = count(lambda f: f == lo)
+    if k < num_lo:
+        return lo
+    k -= num_lo
+    inside = np.concatenate(map_layers(lambda f: f[(f > lo) & (f < hi)], flats,
+                                       parallel=parallel))
+    if k < inside.size:
+        return np.partition(inside, k)[k]
+    return hi
 
-    flatten = tf_utils.concatenate_flattened(saliences)
-    flat_mask = np.ones_like(flatten)
 
-    threshold = np.percentile(flatten, percentage * 100)
+def get_num_pruned(total, percentage):
+    return min(max(int(round(float(percentage) * total)), 0), total)
+
+
+def get_pruning_mask(saliences, percentage, parallel=False):
+    """
+    :param saliences: list of saliences arrays
+    :param percentage: exactly round(percentage * size) weights will be zeroed
+    :param parallel: if True, layers are processed by `get_thread_pool`
+    :return: list of boolean masks with corresponding sizes, True for kept weights
+
+    Ties are broken by the order of layers and then by position in a layer.
+    """
+    total = sum(s.size for s in saliences)
+    num_pruned = get_num_pruned(total, percentage)
+
+    if num_pruned == 0:
+        return [np.ones(s.shape, dtype=bool) for s in saliences]
+    if num_pruned == total:
+        return [np.zeros(s.shape, dtype=bool) for s in saliences]
+
+    threshold = find_kth_smallest(saliences, num_pruned, parallel=parallel)
     # print(f'pruning threshold: {threshold:8.5f}')
-    flat_mask[flatten < threshold] = 0
 
-    cumsizes = np.cumsum(sizes)[:-1]
-    flat_masks = np.split(flat_mask, cumsizes)
-    return [w.reshape(shape) for w, shape in zip(flat_masks, shapes)]
+    def write_mask(s):
+        mask = np.empty(s.shape, dtype=bool)
+        np.greater_equal(s, threshold, out=mask)
+        return mask
+
+    masks = map_layers(write_mask, saliences, parallel=parallel)
+    num_pruned -= total - sum(map_layers(np.count_nonzero, masks, parallel=parallel))
+
+    for s, mask in zip(saliences, masks):
+        if num_pruned == 0:
+            break
+        ties = np.flatnonzero(s == threshold)[:num_pruned]
+        mask.reshape(-1)[ties] = False
+        num_pruned -= ties.size
+    return masks
 
 
-def saliences2masks(saliences_dict, percentage):
+def saliences2masks(saliences_dict, percentage, parallel=False):
     """
     :param saliences_dict: keys are variable names, values are saliences
     :param percentage: float from 0 to 1
+    :param parallel: if True, layers are processed by `get_thread_pool`
     :return: dict, keys are variable names, values are masks
     """
     saliences = list(saliences_dict.values())
-    masks = get_pruning_mask(saliences, percentage)
+    masks = get_pruning_mask(saliences, percentage, parallel=parallel)
+    return {key: mask for key, mask in zip(saliences_dict, masks)}
+
+
+def get_n_m_mask(saliences, n, m):
+    """
+    :param saliences: saliences of Dense or Conv2D kernel
+    :param n: number of weights kept in every group
+    :param m: size of groups of consecutive input channels
+    :return: boolean mask keeping `n` largest saliences in every group
+
+    If the number of input channels isn't divisible by `m`, the last group is
+    smaller and at most `n` of its weights are kept. Ties are broken by position.
+    """
+    s = np.moveaxis(saliences, -2, -1)
+    size = s.shape[-1]
+    s = np.pad(s, [(0, 0)] * (s.ndim - 1) + [(0, -size % m)], constant_values=-np.inf)
+    groups = s.reshape(*s.shape[:-1], -1, m)
+
+    kept = np.argsort(-groups, axis=-1, kind='stable')[..., :n]
+    mask = np.zeros(groups.shape, dtype=bool)
+    np.put_along_axis(mask, kept, True, axis=-1)
+    mask = mask.reshape(s.shape)[..., :size]
+    return np.moveaxis(mask, -1, -2)
+
+
+def saliences2masks_n_m(saliences_dict, n_m, parallel=False):
+    """
+    :param saliences_dict: keys are variable names, values are saliences
+    :param n_m: pair (N, M), N out of every M consecutive input weights are kept
+    :param parallel: if True, layers are processed by `get_thread_pool`
+    :return: dict, keys are variable names, values are masks
+    """
+    n, m = n_m
+    masks = map_layers(lambda s: get_n_m_mask(s, n, m), saliences_dict.values(),
+                       parallel=parallel)
     return {key: mask for key, mask in zip(saliences_dict, masks)}
 
 
+def saliences2ranks(saliences_dict):
+    """
+    :param saliences_dict: keys are variable names, values are saliences
+    :return: dict, keys are variable names, values are global ranks of saliences
+
+    Ranks come from a single stable sort, so ties are broken like in
+    `get_pruning_mask` and masks derived for growing sparsities are nested.
+    Ranks are stored as uint32 whenever possible.
+    """
+    saliences = list(saliences_dict.values())
+    flatten = np.concatenate([s.reshape(-1) for s in saliences])
+    order = np.argsort(flatten, kind='stable')
+    del flatten
+
+    dtype = np.uint32 if order.size < 2 ** 32 else np.uint64
+    flat_ranks = np.empty(order.size, dtype=dtype)
+    flat_ranks[order] = np.arange(order.size, dtype=dtype)
+    del order
+
+    cumsizes = np.cumsum([s.size for s in saliences])[:-1]
+    flat_ranks = np.split(flat_ranks, cumsizes)
+    return {key: r.reshape(s.shape) for key, r, s in
+            zip(saliences_dict, flat_ranks, saliences)}
+
+
+def ranks2masks(ranks_dict, percentage):
+    """
+    :param ranks_dict: keys are variable names, values are ranks from `saliences2ranks`
+    :param percentage: float from 0 to 1
+    :return: dict, keys are variable names, values are boolean masks
+    """
+    total = sum(r.size for r in ranks_dict.values())
+    num_pruned = get_num_pruned(total, percentage)
+    return {key: r >= num_pruned for key, r in ranks_dict.items()}
+
+
+def saliences2masks_many(saliences_dict, percentages):
+    """
+    :param saliences_dict: keys are variable names, values are saliences
+    :param percentages: iterable of floats from 0 to 1
+    :return: generator of dicts like in `saliences2masks`, one for each percentage
+
+    Only ranks are kept, masks are created when the next percentage is requested.
+    """
+    ranks = saliences2ranks(saliences_dict)
+    for percentage in percentages:
+        yield ranks2masks(ranks, percentage)
+
+
+def get_kernel_costs(model, metric='flops', batch_size=1):
+    """
+    :param model: built functional model with masked layers
+    :param metric: 'flops' or 'latency'
+    :param batch_size: batch size used to measure latency
+    :return: dict, keys are kernel names, values are costs of a single weight
+
+    A weight of Conv2D costs one multiply-add for every output position, so the
+    stride is taken into account. Latency of a dense layer is measured on the CPU
+    and split evenly between its weights. This is only an approximation: it scales
+    the number of weights by a per-layer factor and assumes latency of the pruned
+    layer falls linearly with its weights, which dense kernels don't do.
+    """
+    costs = {}
+    for layer in sparse_layers.get_masked_layers(model):
+        if metric == 'flops':
+            spatial_shape = layer.output.shape[1:-1]
+            costs[layer.kernel.name] = float(np.prod(spatial_shape, dtype=np.int64))
+        elif metric == 'latency':
+            seconds = sparse_export.measure_latency(layer, layer.input.shape,
+                                                    batch_size=batch_size)
+            costs[layer.kernel.name] = seconds / layer.kernel.shape.num_elements()
+        else:
+            raise KeyError(f"COST {metric} is unknown!")
+    return costs
+
+
+def get_budget_costs(model, config):
+    """Costs from `get_kernel_costs` for `flops` or `latency` budget in `config`."""
+
+    budgets = [key for key in ('flops', 'latency') if config.get(key)]
+    if not budgets:
+        return None
+    return get_kernel_costs(model, budgets[0], config.get('latency_batch_size') or 1)
+
+
+def saliences2masks_budget(saliences_dict, costs_dict, budget):
+    """
+    :param saliences_dict: keys are variable names, values are saliences
+    :param costs_dict: keys are variable names, values are costs of a single weight
+    :param budget: float from 0 to 1, fraction of the total cost that remains
+    :return: dict, keys are variable names, values are masks
+
+    Saliences can be negative, e.g. from GraSP, so they are shifted to start at 0
+    before dividing, otherwise expensive weights would get larger scores.
+    Weights are pruned in the order of salience divided by cost, until the
+    remaining cost fits the budget. The sum of costs of kept weights is within one
+    weight's cost of the budget. Costs are linear in the number of weights, so for
+    `latency` this is a target for the estimate of `get_kernel_costs`, not for
+    latency measured after pruning.
+    """
+    smallest = min(np.min(s) for s in saliences_dict.values())
+    scores = {key: (s - smallest) / costs_dict[key] for key, s in saliences_dict.items()}
+    ranks = saliences2ranks(scores)
+    del scores
+
+    total = sum(r.size for r in ranks.values())
+    cost_by_rank = np.empty(total, dtype=np.float64)
+    for key, r in ranks.items():
+        cost_by_rank[r.reshape(-1)] = costs_dict[key]
+    cumulative_cost = np.cumsum(cost_by_rank)
+
+    cost_to_prune = (1 - float(budget)) * cumulative_cost[-1]
+    if cost_to_prune <= 0:
+        num_pruned = 0
+    else:
+        num_pruned = min(int(np.searchsorted(cumulative_cost, cost_to_prune)) + 1, total)
+    return {key: r >= num_pruned for key, r in ranks.items()}
+
+
 def extract_kernels(dictionary):
     return {key: value for key, value in dictionary.items() if "kernel" in key}
 
 
 def set_kernel_masks_for_model(model, masks_dict, silent=False):
+    pruned = []
     for mask in masks_dict:
         for layer in model.layers:
             for weight in layer.weights:
                 if mask == weight.name:
                     layer.set_pruning_mask(masks_dict[mask])
-                    if not silent:
-                        print(f"{weight.name:<32} pruning to "
-                              f"{layer.sparsity * 100:6.2f}%"
-                              f" (left {layer.left_unpruned})")
+                    pruned.append((weight.name, layer))
+    if not silent:
+        counts = sparse_layers.count_nonzero([layer for _, layer in pruned])
+        for (name, layer), nonzero in zip(pruned, counts):
+            sparsity = 1 - nonzero / layer.kernel_mask.shape.num_elements()
+            print(f"{name:<32} pruning to "
+                  f"{sparsity * 100:6.2f}%"
+                  f" (left {nonzero})")
 
 
-def prune_by_kernel_masks(model, config, silent=False):
-    sparsity = config.get('sparsity') or 0.0
-    structure = config.get('structure')
-    saliences = {}
-    for layer in model.layers:
-        if hasattr(layer, 'kernel_mask'):
-            kernel = layer.kernel
-            saliences[kernel.name] = layer.kernel_mask.numpy()
-    saliences = extract_kernels(saliences)
-    if structure:
-        saliences = structurize_saliences(saliences)
-    masks = saliences2masks(saliences, percentage=sparsity)
+def compute_saliences(compute, config, checkpoint=None, **description):
+    """
+    :param compute: function without arguments returning dict of saliences
+    :param config: dict, optionally with `structure`, `block`, `parallel`,
+                   `cache_dir` and `cache_max_size` in bytes
+    :param checkpoint: path to the checkpoint the model was loaded from
+    :param description: everything else that changes saliences, e.g. method
+    :return: dict, keys are kernel names, values are saliences, structurized if needed
+
+    Saliences are cached on disk only if both `cache_dir` and `checkpoint` are given.
+    """
+    structure = bool(config.get('structure'))
+    block = tuple(config['block']) if config.get('block') else None
+
+    def compute_structurized():
+        saliences = compute()
+        if structure:
+            saliences = structurize_saliences(saliences, parallel=config.get('parallel'))
+        if block:
+            structurized = map_layers(lambda s: structurize_salience_blocks(s, block),
+                                      saliences.values(), parallel=config.get('parallel'))
+            saliences = dict(zip(saliences, structurized))
+        return saliences
+
+    if not (config.get('cache_dir') and checkpoint):
+        return compute_structurized()
+
+    cache = salience_cache.SalienceCache(config['cache_dir'],
+                                         max_size=config.get('cache_max_size') or 2 ** 33)
+    key = cache.get_key(checkpoint, structure=structure, block=block, **description)
+    saliences = cache.load(key)
+    if saliences is None:
+        saliences = compute_structurized()
+        cache.save(key, saliences)
+        print(f"SAVED SALIENCES TO CACHE {key}")
+    else:
+        print(f"LOADED SALIENCES FROM CACHE {key}")
+    return saliences
+
+
+def prune_by_saliences(model, saliences, config, silent=False):
+    """
+    :param model: model with masked layers
+    :param saliences: dict, keys are kernel names, values are saliences
+    :param config: dict with one of the targets: `sparsity`, `n_m`, `flops` or
+                   `latency`; the last two are fractions of the cost that remains
+                   and optionally `parallel` and `latency_batch_size`
+    :param silent: if False, print the sparsity of every layer
+    :return: model with updated kernel masks
+    """
+    budgets = [key for key in ('flops', 'latency') if config.get(key)]
+    if budgets:
+        metric = budgets[0]
+        costs = get_budget_costs(model, config)
+        masks = saliences2masks_budget(saliences, costs, budget=config[metric])
+        if not silent:
+            remaining = sum(costs[key] * np.count_nonzero(m) for key, m in masks.items())
+            total = sum(costs[key] * m.size for key, m in masks.items())
+            print(f"REMAINING {metric.upper()}: {remaining / total * 100:6.2f}%")
+    elif config.get('n_m'):
+        masks = saliences2masks_n_m(saliences, config['n_m'],
+                                    parallel=config.get('parallel'))
+    else:
+        sparsity = config.get('sparsity') or 0.0
+        masks = saliences2masks(saliences, percentage=sparsity,
+                                parallel=config.get('parallel'))
     set_kernel_masks_for_model(model, masks, silent)
     return model
 
 
-def prune_SNIP(model, dataset, config, silent=False):
+def prune_by_kernel_masks(model, config, silent=False):
+    if config.get('backend') == 'tf':
+        costs = get_budget_costs(model, config)
+        return device_pruning.prune_by_kernel_masks(model, config, silent, costs=costs)
+
+    def compute():
+        return {layer.kernel.name: layer.kernel_mask.numpy().astype(np.float32)
+                for layer in sparse_layers.get_masked_layers(model)}
+
+    saliences = compute_saliences(compute, config)
+    return prune_by_saliences(model, saliences, config, silent)
+
+
+def prune_SNIP(model, dataset, config, silent=False, checkpoint=None):
     """Prune by saliences `|W*G|` for W being weights an G being gradients."""
 
-    sparsity = config.get('sparsity') or 0.0
     batches = config.get('batches') or 1
-    structure = config.get('structure')
 
-    saliences = snip_saliences(model, dataset, batches=batches)
-    saliences = extract_kernels(saliences)
-    if structure:
-        saliences = structurize_saliences(saliences)
-    masks = saliences2masks(saliences, percentage=sparsity)
-    set_kernel_masks_for_model(model, masks, silent)
-    return model
+    def compute():
+        return snip_saliences(model,
+                              dataset,
+                              batches=batches,
+                              micro_batch_size=config.get('micro_batch_size'),
+                              devices=config.get('devices'))
+
+    saliences = compute_saliences(compute, config, checkpoint,
+                                  method='snip', batches=batches)
+    return prune_by_saliences(model, saliences, config, silent)
+
+
+def prune_GraSP(model, dataset, config, silent=False, sign=-1, checkpoint=None):
+    """Prune by saliences `-W*Hg` for H being Hessian and g being gradients."""
+
+    batches = config.get('batches') or 1
+
+    def compute():
+        return grasp_saliences(model,
+                               dataset,
+                               batches=batches,
+                               micro_batch_size=config.get('micro_batch_size'),
+                               devices=config.get('devices'),
+                               mode=config.get('grasp_mode') or 'hvp',
+                               sign=sign)
+
+    saliences = compute_saliences(compute, config, checkpoint,
+                                  method='grasp', sign=sign, batches=batches,
+                                  micro_batch_size=config.get('micro_batch_size'),
+                                  devices=config.get('devices'),
+                                  grasp_mode=config.get('grasp_mode') or 'hvp')
+    return prune_by_saliences(model, saliences, config, silent)
 
 
 def prune_pseudo_SNIP(model, dataset, config, silent=False):
     """In SNIP's `W*G` we replace gradients G with a random from [-1, 1]."""
 
-    sparsity = config.get('sparsity') or 0.0
-    structure = config.get('structure')
-
-    saliences = psuedo_snip_saliences(model)
-    saliences = extract_kernels(saliences)
-    if structure:
-        saliences = structurize_saliences(saliences)
-    masks = saliences2masks(saliences, percentage=sparsity)
-    set_kernel_masks_for_model(model, masks, silent)
-    return model
+    saliences = compute_saliences(lambda: psuedo_snip_saliences(model), config)
+    return prune_by_saliences(model, saliences, config, silent)
 
 
 def prune_random(model, config, silent=False):
     """Random, non-uniform pruning."""
 
-    sparsity = config.get('sparsity') or 0.0
-    structure = config.get('structure')
-    saliences = {w.name: np.random.rand(*w.shape) for w in model.trainable_weights}
-    saliences = extract_kernels(saliences)
-    if structure:
-        saliences = structurize_saliences(saliences)
-    masks = saliences2masks(saliences, percentage=sparsity)
-    set_kernel_masks_for_model(model, masks, silent)
-    return model
+    if config.get('backend') == 'tf':
+        costs = get_budget_costs(model, config)
+        return device_pruning.prune_random(model, config, silent, costs=costs)
+
+    def compute():
+        return {w.name: np.random.rand(*w.shape) for w in get_maskable_kernels(model)}
+
+    saliences = compute_saliences(compute, config)
+    return prune_by_saliences(model, saliences, config, silent)
 
 
-def prune_l1(model, config, silent=False):
+def prune_l1(model, config, silent=False, checkpoint=None):
     """Prune smallest magnitudes."""
 
-    sparsity = config.get('sparsity') or 0.0
-    structure = config.get('structure')
-    saliences = {w.name: np.abs(w.numpy()) for w in model.trainable_weights}
-    saliences = extract_kernels(saliences)
-    if structure:
-        saliences = structurize_saliences(saliences)
-    masks = saliences2masks(saliences, percentage=sparsity)
-    set_kernel_masks_for_model(model, masks, silent)
-    return model
+    if config.get('backend') == 'tf':
+        costs = get_budget_costs(model, config)
+        return device_pruning.prune_l1(model, config, silent, costs=costs)
+
+    def compute():
+        kernels = get_maskable_kernels(model)
+        saliences = map_layers(lambda w: np.abs(w.numpy()), kernels,
+                               parallel=config.get('parallel'))
+        return {w.name: s for w, s in zip(kernels, saliences)}
+
+    saliences = compute_saliences(compute, config, checkpoint, method='magnitude')
+    return prune_by_saliences(model, saliences, config, silent)
 
 
 def shuffle_masks(model):
@@ -282,7 +788,7 @@ def shuffle_weights(model):
     for layer in model.layers:
         if hasattr(layer, "kernel_mask"):
             kernel = layer.kernel.numpy()
-            mask = layer.kernel_mask.numpy().astype(np.bool)
+            mask = layer.kernel_mask.numpy().astype(bool)
             kernel_nonzero = kernel[mask]
             np.random.shuffle(kernel_nonzero)
             kernel[mask] = kernel_nonzero
@@ -312,25 +818,35 @@ def shuffle_layers(model):
     return model
 
 
-def report_density(model, silent=True):
-    nonzero = 0
-    kernels = 0
-    biases = 0
-    for w in model.weights:
-        if 'kernel_mask' in w.name:
-            km = w.numpy()
-            kernels += km.size
-            nonzero_here = (km != 0).sum()
-            nonzero += nonzero_here
-            if not silent:
-                print(f"{w.name:<32} density is {nonzero_here / km.size:6.4f}")
-        if 'bias' in w.name or 'beta' in w.name:
-            biases += w.shape.num_elements()
+def report_density(model, silent=True, per_layer=False):
+    """
+    :param model: model with masked layers
+    :param silent: if False, print density of every layer
+    :param per_layer: if True, return a table instead of the global density
+    :return: float, density of all masked kernels or if `per_layer`
+             list of dicts with `name`, `size`, `nonzero` and `density` of every layer
+    """
+    layers = sparse_layers.get_masked_layers(model)
+    sizes = [l.kernel_mask.shape.num_elements() for l in layers]
+    counts = sparse_layers.count_nonzero(layers)
+    table = [{'name': l.kernel_mask.name,
+              'size': size,
+              'nonzero': int(nonzero),
+              'density': nonzero / size}
+             for l, size, nonzero in zip(layers, sizes, counts)]
+
     if not silent:
-        print(f"Biases make {biases / (kernels + biases) * 100:6.3f}% of weights!")
-    if kernels == 0:
+        for row in table:
+            print(f"{row['name']:<32} density is {row['density']:6.4f}")
+        biases = sum(w.shape.num_elements() for w in model.weights
+                     if 'bias' in w.name or 'beta' in w.name)
+        print(f"Biases make {biases / (sum(sizes) + biases) * 100:6.3f}% of weights!")
+
+    if per_layer:
+        return table
+    if not table:
         return 1.0
-    return nonzero / kernels
+    return sum(row['nonzero'] for row in table) / sum(sizes)
 
 
 def initialize_kernel_masks(model):
@@ -341,7 +857,7 @@ def initialize_kernel_masks(model):
                 'kernel',
                 'kernel_mask'),
                 shape=layer.kernel.shape,
-                dtype=layer.kernel.dtype,
+                dtype=sparse_layers.MaskedDense.mask_dtype,
                 initializer="ones",
                 trainable=False, )
             nmasks += layer.kernel.shape.num_elements()
@@ -352,7 +868,11 @@ def contains_any(t, *opts):
     return any([x in t for x in opts])
 
 
-def set_pruning_masks(model, pruning_method, pruning_config, dataset):
+def set_pruning_masks(model, pruning_method, pruning_config, dataset, checkpoint=None):
+    """
+    :param checkpoint: path to the checkpoint the model was loaded from,
+                       used as a key in the salience cache, see `compute_saliences`
+    """
     if (pruning_method is None
             or contains_any(pruning_method.lower(), 'none', 'nothing')):
         print('NO PRUNING')
@@ -370,10 +890,25 @@ def set_pruning_masks(model, pruning_method, pruning_config, dataset):
             print('SNIP PRUNING')
             model = prune_SNIP(model=model,
                                config=pruning_config,
-                               dataset=dataset['train'])
+                               dataset=dataset['train'],
+                               checkpoint=checkpoint)
+    elif contains_any(pruning_method.lower(), 'grasp'):
+        if contains_any(pruning_method.lower(), 'minus'):
+            print('MINUS GRASP PRUNING')
+            model = prune_GraSP(model=model,
+                                config=pruning_config,
+                                dataset=dataset['train'],
+                                sign=1,
+                                checkpoint=checkpoint)
+        else:
+            print('GRASP PRUNING')
+            model = prune_GraSP(model=model,
+                                config=pruning_config,
+                                dataset=dataset['train'],
+                                checkpoint=checkpoint)
     elif contains_any(pruning_method.lower(), 'l1', 'magnitude'):
         print('WEIGHT MAGNITUDE PRUNING')
-        model = prune_l1(model=model, config=pruning_config)
+        model = prune_l1(model=model, config=pruning_config, checkpoint=checkpoint)
     elif contains_any(pruning_method.lower(), 'kernel mask'):
         print("PRUNING BY KERNEL MASK VALUES")
         model = prune_by_kernel_masks(model=model, config=pruning_config)
@@ -383,11 +918,11 @@ def set_pruning_masks(model, pruning_method, pruning_config, dataset):
 
 
 def apply_pruning_for_model(model):
-    """Set masked weights to 0."""
+    """Set masked weights to 0, with masked gradients also their optimizer slots."""
 
     for layer in model.layers:
         if hasattr(layer, "apply_pruning_mask"):
-            layer.apply_pruning_mask()
+            layer.apply_pruning_mask(optimizer=getattr(model, "optimizer", None))
 
 
 def apply_pruning_masks(model, pruning_method):
@@ -419,22 +954,27 @@ def get_kernel_masks(model):
 def set_kernel_masks_values_on_model(model, values):
     for i, kernel in enumerate(get_kernel_masks(model)):
         if isinstance(values, int) or isinstance(values, float):
-            mask = np.ones_like(kernel.numpy()) * values
+            mask = np.full(kernel.shape, values)
         else:
             mask = values[i]
-        kernel.assign(mask)
+        kernel.assign(tf.cast(mask, kernel.dtype))
+    sparse_layers.count_masks(model)
 
 
 def set_kernel_masks_values(masks, values):
+    masks = list(masks)
     if isinstance(values, int) or isinstance(values, float):
         for mask in masks:
-            mask.assign(np.ones_like(mask.numpy()) * values)
+            mask.assign(tf.fill(mask.shape, tf.cast(values, mask.dtype)))
     else:
         for mask, value in zip(masks, values):
-            mask.assign(value)
+            mask.assign(tf.cast(value, mask.dtype))
+    sparse_layers.count_mask_variables(masks)
 
 
 def set_kernel_masks_object(model, masks):
     layers = (l for l in model.layers if hasattr(l, 'kernel_mask'))
     for l, km in zip(layers, masks):
         l.kernel_mask = km
+        if isinstance(l, sparse_layers.MaskedLayer):
+            l.count_mask()
@@ -0,0 +1,109 @@
+"""On-disk cache of saliences, keyed by checkpoint content and pruning method."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    from ._initialize import *
+except ImportError:
+    pass
+
+_file_hashes = {}
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    """sha256 of the file content, memoized by path, size and modification time."""
+
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                digest.update(chunk)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+
+class SalienceCache:
+    """
+    Every entry is a directory with one `.npy` file per kernel and `index.json`
+    with kernel names. Entries are loaded memory-mapped. When the cache grows
+    over `max_size` bytes, least recently used entries are removed.
+    """
+
+    def __init__(self, directory, max_size=2 ** 33):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, checkpoint, **description):
+        """
+        :param checkpoint: path to the checkpoint the model was loaded from
+        :param description: everything else that changes saliences, e.g. method
+        :return: str, name of the entry
+        """
+        description['checkpoint'] = hash_file(checkpoint)
+        serialized = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()[:32]
+
+    def load(self, key):
+        """
+        :param key: str from `get_key`
+        :return: dict, keys are kernel names, values are memory-mapped saliences
+                 or None if there's no such entry
+        """
+        path = os.path.join(self.directory, key)
+        index_path = os.path.join(path, 'index.json')
+        if not os.path.exists(index_path):
+            return None
+
+        with open(index_path, 'r') as f:
+            names = json.load(f)
+        os.utime(path)  # mark as recently used
+        return {name: np.load(os.path.join(path, f'{idx}.npy'), mmap_mode='r')
+                for idx, name in enumerate(names)}
+
+    def save(self, key, saliences):
+        """
+        :param key: str from `get_key`
+        :param saliences: dict, keys are kernel names, values are saliences
+        :return: None
+        """
+        path = os.path.join(self.directory, key)
+        temp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        for idx, salience in enumerate(saliences.values()):
+            np.save(os.path.join(temp_path, f'{idx}.npy'), np.asarray(salience))
+        with open(os.path.join(temp_path, 'index.json'), 'w') as f:
+            json.dump(list(saliences), f)
+
+        try:
+            os.rename(temp_path, path)  # atomic, concurrent runs can't see half an entry
+        except OSError:
+            shutil.rmtree(temp_path)  # other run has just saved the same entry
+        self.evict()
+
+    def get_entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.get_entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:  # never remove the newest entry
+            if total_size <= self.max_size:
+                break
+            print(f"SALIENCE CACHE: REMOVING {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
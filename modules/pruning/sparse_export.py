@@ -0,0 +1,188 @@
+"""Export of pruned models for inference with sparse Dense and 1x1 Conv2D kernels.
+
+Whether a sparse kernel is faster depends on the density, shapes, batch size and
+the host, so by default every layer is timed in both versions and the faster
+one is used. With `crossover` given, layers with density up to it become sparse.
+
+With `block` given, kernels pruned with the same `block` in `pruning_config` are
+stored as nonzero blocks instead, which works for Conv2D of any kernel size.
+With `n_m` given, N:M pruned kernels are stored packed to save memory and all
+Dense and Conv2D layers are exported without timing.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from modules.pruning import n_m_packing, sparse_layers, surgery
+
+try:
+    from ._initialize import *
+except ImportError:
+    pass
+
+
+def is_exportable(layer, block=None):
+    if type(layer) in surgery.DENSE_LAYERS:
+        return layer.input.shape.rank == 2
+    if type(layer) in surgery.CONV_LAYERS:
+        return ((block or tuple(layer.kernel_size) == (1, 1))
+                and tuple(layer.dilation_rate) == (1, 1)
+                and layer.groups == 1)
+    return False
+
+
+def to_packed_layer(layer, n_m):
+    kernel = surgery.get_masked_kernel(layer)
+    weights = list(n_m_packing.pack_kernel(kernel, kernel != 0, n_m))
+    kwds = {'activation': layer.activation, 'name': layer.name}
+    if layer.use_bias:
+        weights.append(layer.bias.numpy())
+
+    if type(layer) in surgery.CONV_LAYERS:
+        sparse_layer = sparse_layers.PackedNMConv(layer.filters, n_m,
+                                                  kernel_size=layer.kernel_size,
+                                                  strides=layer.strides,
+                                                  padding=layer.padding,
+                                                  use_bias=layer.use_bias,
+                                                  **kwds)
+    else:
+        sparse_layer = sparse_layers.PackedNMDense(layer.units, n_m,
+                                                   use_bias=layer.use_bias, **kwds)
+    return sparse_layer, weights
+
+
+def to_sparse_layer(layer, block=None, n_m=None):
+    """
+    :param layer: Dense or Conv2D layer, masked or not
+    :param block: if given, layer is block sparse with blocks of this shape
+    :param n_m: if given, layer stores N:M sparse kernel packed
+    :return: sparse layer and its weights, to be set after it's built
+    """
+    if n_m:
+        return to_packed_layer(layer, n_m)
+
+    kernel = surgery.get_masked_kernel(layer)
+    bias = layer.bias.numpy() if layer.use_bias else None
+    kwds = {'activation': layer.activation, 'name': layer.name}
+    is_conv = type(layer) in surgery.CONV_LAYERS
+
+    if block:
+        if is_conv:
+            kwds.update(kernel_size=layer.kernel_size, strides=layer.strides,
+                        padding=layer.padding)
+            layer_class = sparse_layers.BlockSparseConv
+        else:
+            layer_class = sparse_layers.BlockSparseDense
+        return layer_class.from_kernel(kernel, block, bias, **kwds)
+
+    if is_conv:
+        kwds['strides'] = layer.strides
+        layer_class = sparse_layers.SparseConv1x1
+    else:
+        layer_class = sparse_layers.SparseDense
+    return layer_class.from_kernel(kernel, bias, **kwds)
+
+
+def get_density(layer, block=None):
+    """Fraction of nonzero weights or, if `block` is given, of nonzero blocks."""
+
+    kernel = surgery.get_masked_kernel(layer)
+    if block:
+        _, weights = sparse_layers.BlockSparseDense.from_kernel(kernel, block)
+        flat = kernel.reshape(-1, kernel.shape[-1])
+        num_blocks = (-(-flat.shape[0] // block[0])) * (-(-flat.shape[1] // block[1]))
+        return len(weights[0]) / num_blocks
+    return np.count_nonzero(kernel) / kernel.size
+
+
+def measure_latency(layer, input_shape, weights=None, batch_size=1, repeats=20):
+    """
+    :param layer: layer to be timed, built or not
+    :param input_shape: shape of the layer's input, batch dimension is ignored
+    :param weights: if given, set after the layer is built
+    :param batch_size: batch size of the random input
+    :param repeats: number of timed calls, the fastest is returned
+    :return: seconds per call
+    """
+    x = tf.random.uniform((batch_size, *input_shape[1:]))
+    call = tf.function(layer)
+    call(x)
+    if weights is not None:
+        layer.set_weights(weights)
+
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        call(x).numpy()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def choose_sparse_layers(model, batch_size=1, crossover=None, block=None, n_m=None,
+                         silent=False):
+    """
+    :param model: model with pruned Dense or Conv2D layers
+    :param batch_size: batch size expected during the inference
+    :param crossover: if given, layers with density up to it are chosen without timing
+    :param block: if given, layers are block sparse with blocks of this shape
+    :param n_m: if given, all layers store N:M sparse kernels packed
+    :param silent: if False, print the decision for every layer
+    :return: set of names of layers that should be sparse
+    """
+    chosen = set()
+    for layer in model.layers:
+        if not is_exportable(layer, block or n_m):
+            continue
+        density = get_density(layer, block)
+        if n_m:
+            is_sparse = True
+            reason = f"packed {n_m[0]}:{n_m[1]}"
+        elif crossover is not None:
+            is_sparse = density <= crossover
+            reason = f"crossover {crossover}"
+        else:
+            sparse_layer, weights = to_sparse_layer(layer, block)
+            input_shape = layer.input.shape
+            dense_time = measure_latency(layer, input_shape, batch_size=batch_size)
+            sparse_time = measure_latency(sparse_layer, input_shape, weights=weights,
+                                          batch_size=batch_size)
+            is_sparse = sparse_time < dense_time
+            reason = f"{dense_time * 1e6:.1f}us dense vs {sparse_time * 1e6:.1f}us sparse"
+
+        if is_sparse:
+            chosen.add(layer.name)
+        if not silent:
+            print(f"{layer.name:<32} density {density:6.4f} "
+                  f"{'SPARSE' if is_sparse else 'DENSE'} ({reason})")
+    return chosen
+
+
+def export_model(model, batch_size=1, crossover=None, block=None, n_m=None, silent=False):
+    """
+    :param model: functional model with pruned Dense or Conv2D layers
+    :param batch_size: batch size expected during the inference
+    :param crossover: see `choose_sparse_layers`
+    :param block: see `choose_sparse_layers`
+    :param n_m: see `choose_sparse_layers`
+    :param silent: if False, print the decision for every layer
+    :return: new model for inference, with sparse kernels where they are faster
+    """
+    chosen = choose_sparse_layers(model, batch_size, crossover, block, n_m, silent)
+    sparse_weights = {}
+
+    def clone_function(layer):
+        if layer.name in chosen:
+            sparse_layer, sparse_weights[layer.name] = to_sparse_layer(layer, block, n_m)
+            return sparse_layer
+        return surgery.copy_layer(layer)
+
+    new_model = tf.keras.models.clone_model(model, clone_function=clone_function)
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.InputLayer) or not layer.weights:
+            continue
+        new_layer = new_model.get_layer(layer.name)
+        new_layer.set_weights(sparse_weights.get(layer.name, layer.get_weights()))
+    sparse_layers.count_masks(new_model)
+    return new_model
@@ -1,34 +1,96 @@
+import weakref
+
 import numpy as np
 import tensorflow as tf
 
 
-class MaskedDense(tf.keras.layers.Dense):
-    def __init__(self, *args, **kwds):
-        super().__init__(*args, **kwds)
+def mask_kernel(kernel, mask):
+    """
+    :param kernel: kernel variable, possibly autocasted in mixed precision
+    :param mask: kernel mask of any dtype, zeros are pruned
+    :return: masked kernel in the compute dtype
+    """
+    kernel = tf.convert_to_tensor(kernel)
+    return tf.multiply(kernel, tf.cast(mask, kernel.dtype))
 
-    def build(self, input_shape):
-        super().build(input_shape)
 
+def mask_gradient(kernel, mask):
+    """
+    :param kernel: kernel variable with pruned weights already set to 0
+    :param mask: kernel mask of any dtype, zeros are pruned
+    :return: kernel in the compute dtype, its gradient is masked in the backward pass
+    """
+
+    @tf.custom_gradient
+    def identity(w):
+        def grad(dy):
+            return tf.multiply(dy, tf.cast(mask, dy.dtype))
+
+        return tf.identity(w), grad
+
+    return identity(tf.convert_to_tensor(kernel))
+
+
+def mask_optimizer_slots(optimizer, kernel, mask):
+    """
+    :param optimizer: optimizer of the model or None
+    :param kernel: kernel variable
+    :param mask: kernel mask of any dtype, zeros are pruned
+    :return: None
+
+    With zeroed slots (e.g. momentum) and masked gradients, pruned weights stay 0.
+    """
+    if optimizer is None or not hasattr(optimizer, 'get_slot_names'):
+        return
+    for slot_name in optimizer.get_slot_names():
+        try:
+            slot = optimizer.get_slot(kernel, slot_name)
+        except KeyError:  # slots aren't created before the first step
+            continue
+        slot.assign(mask_kernel(slot, mask))
+
+
+# layers by id of their `kernel_mask`, so masks written directly can be recounted
+_mask_owners = weakref.WeakValueDictionary()
+
+
+class MaskedLayer:
+    """Mask handling shared by `MaskedDense` and `MaskedConv`.
+
+    `nonzero` is a counter of unpruned weights kept on the device. It's updated
+    whenever the mask is written here or in `device_pruning`, so reading density
+    doesn't reduce the mask. It isn't a weight of the layer, so checkpoints stay
+    the same; after writing `kernel_mask` directly, call `count_mask`.
+    """
+
+    # masks are ones and zeros, `bool` takes a byte per weight in memory and in h5
+    # float masks from older checkpoints are converted when loaded
+    mask_dtype = 'bool'
+    # if True, kernel is used directly and only its gradient is masked
+    # pruned weights are kept at 0 by zeroing them and their optimizer slots
+    mask_gradients = False
+
+    def build_kernel_mask(self):
         self.kernel_mask = self.add_weight(
             name="kernel_mask",
             shape=self.kernel.shape,
-            dtype=self.kernel.dtype,
+            dtype=self.mask_dtype,
             initializer="ones",
             trainable=False,
         )
+        with tf.init_scope():
+            nonzero = tf.Variable(self.kernel.shape.num_elements(),
+                                  dtype=tf.int64,
+                                  trainable=False,
+                                  name="nonzero")
+        # bypasses tracking by Keras, so the counter isn't saved with the weights
+        object.__setattr__(self, 'nonzero', nonzero)
+        _mask_owners[id(self.kernel_mask)] = self
 
-        self.sparsity = 1 - np.mean(self.kernel_mask.numpy())
-
-    def call(self, x):
-        masked_w = tf.multiply(self.kernel, self.kernel_mask)
-        # masked_w = masked_w / tf.reduce_mean(self.kernel_mask)
-
-        result = tf.matmul(x, masked_w)
-
-        if self.use_bias:
-            result = tf.add(result, self.bias)
-
-        return self.activation(result)
+    def get_masked_kernel(self):
+        if self.mask_gradients:
+            return mask_gradient(self.kernel, self.kernel_mask)
+        return mask_kernel(self.kernel, self.kernel_mask)
 
     def set_pruning_mask(self, new_mask: np.ndarray):
         """
@@ -36,32 +98,61 @@ class MaskedDense(tf.keras.layers.Dense):
         :return: None
         """
         tf.assert_equal(new_mask.shape, self.kernel_mask.shape)
+        new_mask = tf.cast(new_mask, self.kernel_mask.dtype)
         self.kernel_mask.assign(new_mask)
-        self.sparsity = 1 - np.mean(self.kernel_mask.numpy())
-        self.left_unpruned = np.sum(self.kernel_mask.numpy() == 1)
+        self.nonzero.assign(tf.math.count_nonzero(new_mask))
+        if self.mask_gradients:
+            self.apply_pruning_mask()
+
+    def count_mask(self):
+        """Updates `nonzero` after `kernel_mask` was written directly or replaced."""
+        _mask_owners[id(self.kernel_mask)] = self
+        self.nonzero.assign(tf.math.count_nonzero(self.kernel_mask))
+
+    @property
+    def sparsity(self):
+        return 1 - self.left_unpruned / self.kernel_mask.shape.num_elements()
 
-    def apply_pruning_mask(self):
-        self.kernel.assign(tf.multiply(self.kernel, self.kernel_mask))
+    @property
+    def left_unpruned(self):
+        return int(self.nonzero)
 
+    def apply_pruning_mask(self, optimizer=None):
+        self.kernel.assign(mask_kernel(self.kernel, self.kernel_mask))
+        if self.mask_gradients:
+            mask_optimizer_slots(optimizer, self.kernel, self.kernel_mask)
 
-class MaskedConv(tf.keras.layers.Conv2D):
+
+class MaskedDense(tf.keras.layers.Dense, MaskedLayer):
     def __init__(self, *args, **kwds):
         super().__init__(*args, **kwds)
 
     def build(self, input_shape):
         super().build(input_shape)
+        self.build_kernel_mask()
 
-        self.kernel_mask = self.add_weight(
-            name="kernel_mask",
-            shape=self.kernel.shape,
-            dtype=self.kernel.dtype,
-            initializer="ones",
-            trainable=False,
-        )
-        self.sparsity = 1 - np.mean(self.kernel_mask.numpy())
+    def call(self, x):
+        masked_w = self.get_masked_kernel()
+        # masked_w = masked_w / tf.reduce_mean(self.kernel_mask)
+
+        result = tf.matmul(x, masked_w)
+
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+
+        return self.activation(result)
+
+
+class MaskedConv(tf.keras.layers.Conv2D, MaskedLayer):
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+
+    def build(self, input_shape):
+        super().build(input_shape)
+        self.build_kernel_mask()
 
     def call(self, x):
-        masked_w = tf.multiply(self.kernel, self.kernel_mask)
+        masked_w = self.get_masked_kernel()
         # masked_w = masked_w / tf.reduce_mean(self.kernel_mask)
 
         result = tf.nn.conv2d(
@@ -73,15 +164,425 @@ class MaskedConv(tf.keras.layers.Conv2D):
 
         return self.activation(result)
 
-    def set_pruning_mask(self, new_mask: np.ndarray):
+
+class SparseDense(tf.keras.layers.Layer):
+    """Inference-only Dense with the transposed kernel stored as a `tf.SparseTensor`."""
+
+    def __init__(self, units, nnz, use_bias=True, activation=None, **kwds):
+        super().__init__(**kwds)
+        self.units = units
+        self.nnz = nnz
+        self.use_bias = use_bias
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        self.input_dim = int(input_shape[-1])
+        self.kernel_indices = self.add_weight(
+            name="kernel_indices",
+            shape=(self.nnz, 2),
+            dtype=tf.int64,
+            initializer="zeros",
+            trainable=False,
+        )
+        self.kernel_values = self.add_weight(
+            name="kernel_values",
+            shape=(self.nnz,),
+            initializer="zeros",
+            trainable=False,
+        )
+        if self.use_bias:
+            self.bias = self.add_weight(
+                name="bias",
+                shape=(self.units,),
+                initializer="zeros",
+                trainable=False,
+            )
+        super().build(input_shape)
+
+    def matmul(self, x):
+        kernel_t = tf.SparseTensor(self.kernel_indices,
+                                   self.kernel_values,
+                                   dense_shape=(self.units, self.input_dim))
+        x = tf.cast(x, self.kernel_values.dtype)
+        # sparse matrix has to be the left operand: (W^T x^T)^T
+        result = tf.transpose(tf.sparse.sparse_dense_matmul(kernel_t, x, adjoint_b=True))
+        result.set_shape(x.shape[:-1].concatenate([self.units]))
+        return result
+
+    def call(self, x):
+        result = self.matmul(x)
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+        return self.activation(result)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'units': self.units,
+            'nnz': self.nnz,
+            'use_bias': self.use_bias,
+            'activation': tf.keras.activations.serialize(self.activation),
+        })
+        return config
+
+    @classmethod
+    def from_kernel(cls, kernel, bias=None, **kwds):
         """
-        :param new_mask: mask of the same shape as `layer.kernel`
-        :return: None
+        :param kernel: NumPy kernel of Dense or 1x1 Conv2D, zeros are skipped
+        :param bias: NumPy bias or None
+        :param kwds: other arguments of the layer, like `activation` or `name`
+        :return: layer and list of its weights, to be set after it's built
         """
-        tf.assert_equal(new_mask.shape, self.kernel_mask.shape)
-        self.kernel_mask.assign(new_mask)
-        self.sparsity = 1 - np.mean(self.kernel_mask.numpy())
-        self.left_unpruned = np.sum(self.kernel_mask.numpy() == 1)
+        kernel_t = kernel.reshape(-1, kernel.shape[-1]).T
+        indices = np.argwhere(kernel_t != 0)  # row-major, as `tf.SparseTensor` needs
+        weights = [indices.astype(np.int64), kernel_t[kernel_t != 0]]
+        if bias is not None:
+            weights.append(bias)
+        layer = cls(units=kernel_t.shape[0], nnz=len(indices), use_bias=bias is not None,
+                    **kwds)
+        return layer, weights
+
+
+class SparseConv1x1(SparseDense):
+    """Inference-only 1x1 Conv2D, every pixel is multiplied by the sparse kernel."""
+
+    def __init__(self, units, nnz, strides=(1, 1), **kwds):
+        super().__init__(units, nnz, **kwds)
+        self.strides = tuple(strides)
+
+    def call(self, x):
+        x = x[:, ::self.strides[0], ::self.strides[1]]
+        shape = tf.shape(x)
+        flat = tf.reshape(x, (-1, self.input_dim))
+        result = tf.reshape(self.matmul(flat), tf.concat([shape[:-1], [self.units]], 0))
+        result.set_shape(x.shape[:-1].concatenate([self.units]))
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+        return self.activation(result)
+
+    def get_config(self):
+        config = super().get_config()
+        config['strides'] = self.strides
+        return config
+
+
+class BlockSparseDense(tf.keras.layers.Layer):
+    """Inference-only Dense storing only nonzero blocks of the kernel.
+
+    Input is split into blocks of rows, blocks that meet a nonzero kernel block are
+    gathered and multiplied, products are summed into blocks of outputs.
+    """
+
+    def __init__(self, units, block, num_blocks, use_bias=True, activation=None, **kwds):
+        super().__init__(**kwds)
+        self.units = units
+        self.block = tuple(block)
+        self.num_blocks = num_blocks
+        self.use_bias = use_bias
+        self.activation = tf.keras.activations.get(activation)
+
+    def get_input_dim(self, input_shape):
+        return int(input_shape[-1])
+
+    def build(self, input_shape):
+        self.input_dim = self.get_input_dim(input_shape)
+        self.block_values = self.add_weight(
+            name="block_values",
+            shape=(self.num_blocks, *self.block),
+            initializer="zeros",
+            trainable=False,
+        )
+        self.block_rows = self.add_weight(
+            name="block_rows",
+            shape=(self.num_blocks,),
+            dtype=tf.int32,
+            initializer="zeros",
+            trainable=False,
+        )
+        self.block_cols = self.add_weight(
+            name="block_cols",
+            shape=(self.num_blocks,),
+            dtype=tf.int32,
+            initializer="zeros",
+            trainable=False,
+        )
+        if self.use_bias:
+            self.bias = self.add_weight(
+                name="bias",
+                shape=(self.units,),
+                initializer="zeros",
+                trainable=False,
+            )
+        super().build(input_shape)
+
+    def matmul(self, x):
+        block_rows, block_cols = self.block
+        num_rows = -(-self.input_dim // block_rows)
+        num_cols = -(-self.units // block_cols)
+
+        x = tf.cast(x, self.block_values.dtype)
+        x = tf.pad(x, [[0, 0], [0, num_rows * block_rows - self.input_dim]])
+        x = tf.reshape(x, (-1, num_rows, block_rows))
+        x = tf.gather(x, self.block_rows, axis=1)
+
+        products = tf.einsum('nbi,bio->bno', x, self.block_values)
+        result = tf.math.unsorted_segment_sum(products, self.block_cols, num_cols)
+        result = tf.reshape(tf.transpose(result, (1, 0, 2)), (-1, num_cols * block_cols))
+        return result[:, :self.units]
+
+    def call(self, x):
+        result = self.matmul(x)
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+        return self.activation(result)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'units': self.units,
+            'block': self.block,
+            'num_blocks': self.num_blocks,
+            'use_bias': self.use_bias,
+            'activation': tf.keras.activations.serialize(self.activation),
+        })
+        return config
+
+    @classmethod
+    def from_kernel(cls, kernel, block, bias=None, **kwds):
+        """
+        :param kernel: NumPy kernel of Dense or Conv2D, blocks of zeros are skipped
+        :param block: (rows, columns) of a block in the kernel reshaped to 2D
+        :param bias: NumPy bias or None
+        :param kwds: other arguments of the layer, like `activation` or `name`
+        :return: layer and list of its weights, to be set after it's built
+        """
+        flat = kernel.reshape(-1, kernel.shape[-1])
+        block_rows, block_cols = block
+        flat = np.pad(flat, [[0, -flat.shape[0] % block_rows],
+                             [0, -flat.shape[1] % block_cols]])
+        blocks = flat.reshape(flat.shape[0] // block_rows, block_rows,
+                              flat.shape[1] // block_cols, block_cols).swapaxes(1, 2)
+        rows, cols = np.nonzero(np.any(blocks != 0, axis=(2, 3)))
+
+        weights = [blocks[rows, cols], rows.astype(np.int32), cols.astype(np.int32)]
+        if bias is not None:
+            weights.append(bias)
+        layer = cls(units=kernel.shape[-1], block=block, num_blocks=len(rows),
+                    use_bias=bias is not None, **kwds)
+        return layer, weights
+
+
+class BlockSparseConv(BlockSparseDense):
+    """Inference-only Conv2D, im2col patches are multiplied by the block sparse kernel."""
+
+    def __init__(self, units, block, num_blocks, kernel_size=(1, 1), strides=(1, 1),
+                 padding='valid', **kwds):
+        super().__init__(units, block, num_blocks, **kwds)
+        self.kernel_size = tuple(kernel_size)
+        self.strides = tuple(strides)
+        self.padding = padding
+
+    def get_input_dim(self, input_shape):
+        return int(np.prod(self.kernel_size) * input_shape[-1])
+
+    def call(self, x):
+        # patches are flattened in the (rows, cols, channels) order, like kernels
+        patches = tf.image.extract_patches(x,
+                                           sizes=(1, *self.kernel_size, 1),
+                                           strides=(1, *self.strides, 1),
+                                           rates=(1, 1, 1, 1),
+                                           padding=self.padding.upper())
+        shape = tf.shape(patches)
+        flat = tf.reshape(patches, (-1, self.input_dim))
+        result = tf.reshape(self.matmul(flat), tf.concat([shape[:-1], [self.units]], 0))
+        result.set_shape(patches.shape[:-1].concatenate([self.units]))
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+        return self.activation(result)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'kernel_size': self.kernel_size,
+            'strides': self.strides,
+            'padding': self.padding,
+        })
+        return config
+
+
+def unpack_n_m(values, positions, input_dim, m):
+    """TF version of `n_m_packing.unpack_kernel`, returns only the kernel."""
+
+    # values are summed into groups of M + 1, position M collects the unused entries
+    # so the only buffer is about the size of the dense kernel
+    num_groups = values.shape[:-1].num_elements()
+    offsets = tf.range(num_groups)[:, tf.newaxis] * (m + 1)
+    ids = offsets + tf.reshape(tf.cast(positions, tf.int32), (num_groups, -1))
+    groups = tf.math.unsorted_segment_sum(tf.reshape(values, (num_groups, -1)), ids,
+                                          num_groups * (m + 1))
+    groups = tf.reshape(groups, (*values.shape[:-1], m + 1))[..., :m]
+    kernel = tf.reshape(groups, (*groups.shape[:-2], -1))[..., :input_dim]
+    rank = len(kernel.shape)
+    return tf.transpose(kernel, list(range(rank - 2)) + [rank - 1, rank - 2])
+
+
+class PackedNMDense(tf.keras.layers.Layer):
+    """Inference-only Dense storing N:M sparse kernel packed, see `n_m_packing`.
+
+    Inputs at the kept positions are gathered and multiplied by the packed values,
+    the dense kernel isn't built.
+    """
+
+    def __init__(self, units, n_m, use_bias=True, activation=None, **kwds):
+        super().__init__(**kwds)
+        self.units = units
+        self.n_m = tuple(n_m)
+        self.use_bias = use_bias
+        self.activation = tf.keras.activations.get(activation)
+
+    def get_kernel_prefix(self):
+        return ()
+
+    def build(self, input_shape):
+        self.input_dim = int(input_shape[-1])
+        n, m = self.n_m
+        shape = (*self.get_kernel_prefix(), self.units, -(-self.input_dim // m), n)
+        self.kernel_values = self.add_weight(
+            name="kernel_values",
+            shape=shape,
+            initializer="zeros",
+            trainable=False,
+        )
+        self.kernel_positions = self.add_weight(
+            name="kernel_positions",
+            shape=shape,
+            dtype=tf.uint8,
+            initializer="zeros",
+            trainable=False,
+        )
+        if self.use_bias:
+            self.bias = self.add_weight(
+                name="bias",
+                shape=(self.units,),
+                initializer="zeros",
+                trainable=False,
+            )
+        super().build(input_shape)
+
+    def get_kernel(self):
+        return unpack_n_m(self.kernel_values, self.kernel_positions, self.input_dim,
+                          self.n_m[1])
+
+    def matmul(self, x):
+        """Product of `x` of shape (batch, taps, input_dim) and the kernel."""
+        n, m = self.n_m
+        taps = int(np.prod(self.get_kernel_prefix()))
+        num_groups = self.kernel_values.shape[-2]
+        # one zero column after the groups, unused positions point to it
+        width = num_groups * m + 1
+
+        x = tf.cast(x, self.kernel_values.dtype)
+        x = tf.pad(x, [[0, 0], [0, 0], [0, width - self.input_dim]])
+        x = tf.reshape(x, (-1, taps * width))
+
+        shape = (taps, self.units, num_groups, n)
+        values = tf.reshape(self.kernel_values, shape)
+        positions = tf.reshape(tf.cast(self.kernel_positions, tf.int32), shape)
+        ids = tf.where(positions < m,
+                       positions + tf.range(num_groups)[:, tf.newaxis] * m,
+                       width - 1)
+        ids += tf.range(taps)[:, tf.newaxis, tf.newaxis, tf.newaxis] * width
+        x = tf.gather(x, ids, axis=1)
+        return tf.einsum('ntugk,tugk->nu', x, values)
+
+    def call(self, x):
+        shape = tf.shape(x)
+        result = self.matmul(tf.reshape(x, (-1, 1, self.input_dim)))
+        result = tf.reshape(result, tf.concat([shape[:-1], [self.units]], 0))
+        result.set_shape(x.shape[:-1].concatenate([self.units]))
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+        return self.activation(result)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'units': self.units,
+            'n_m': self.n_m,
+            'use_bias': self.use_bias,
+            'activation': tf.keras.activations.serialize(self.activation),
+        })
+        return config
+
+
+class PackedNMConv(PackedNMDense):
+    """Inference-only Conv2D storing N:M sparse kernel packed, see `n_m_packing`."""
+
+    def __init__(self, units, n_m, kernel_size=(1, 1), strides=(1, 1), padding='valid',
+                 **kwds):
+        super().__init__(units, n_m, **kwds)
+        self.kernel_size = tuple(kernel_size)
+        self.strides = tuple(strides)
+        self.padding = padding
+
+    def get_kernel_prefix(self):
+        return self.kernel_size
+
+    def call(self, x):
+        # patches are flattened in the (rows, cols, channels) order, like kernels
+        patches = tf.image.extract_patches(x,
+                                           sizes=(1, *self.kernel_size, 1),
+                                           strides=(1, *self.strides, 1),
+                                           rates=(1, 1, 1, 1),
+                                           padding=self.padding.upper())
+        shape = tf.shape(patches)
+        taps = int(np.prod(self.kernel_size))
+        result = self.matmul(tf.reshape(patches, (-1, taps, self.input_dim)))
+        result = tf.reshape(result, tf.concat([shape[:-1], [self.units]], 0))
+        result.set_shape(patches.shape[:-1].concatenate([self.units]))
+        if self.use_bias:
+            result = tf.add(result, self.bias)
+        return self.activation(result)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'kernel_size': self.kernel_size,
+            'strides': self.strides,
+            'padding': self.padding,
+        })
+        return config
+
+
+def get_masked_layers(model):
+    return [l for l in model.layers if hasattr(l, 'kernel_mask')]
+
+
+def count_masks(model):
+    """Updates `nonzero` counters after masks were written directly, e.g. loaded."""
+    for layer in model.layers:
+        if isinstance(layer, MaskedLayer):
+            layer.count_mask()
+
+
+def count_mask_variables(masks):
+    """Updates `nonzero` counters of layers owning `masks`, after they were assigned."""
+    for mask in masks:
+        layer = _mask_owners.get(id(mask))
+        if layer is not None and layer.kernel_mask is mask:
+            layer.count_mask()
+
+
+def count_nonzero(layers):
+    """
+    :param layers: layers with `kernel_mask`
+    :return: NumPy array with number of unpruned weights in every layer
 
-    def apply_pruning_mask(self):
-        self.kernel.assign(tf.multiply(self.kernel, self.kernel_mask))
+    Counters of `MaskedLayer` are read without counting, masks of other layers are
+    counted on the device, all counts are copied to host at once.
+    """
+    if not layers:
+        return np.zeros(0, dtype=np.int64)
+    return tf.stack([l.nonzero if isinstance(l, MaskedLayer)
+                     else tf.math.count_nonzero(l.kernel_mask)
+                     for l in layers]).numpy()
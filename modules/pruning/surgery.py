@@ -0,0 +1,306 @@
+"""Physical removal of pruned channels, so structurally pruned models get smaller.
+
+Channels are tracked through the functional graph: every tensor has an id for each
+of its channels and ids of tensors that are added together are joined. A channel
+is kept if it is produced by some Conv2D or Dense layer (its masked kernel or bias
+is nonzero) and it is consumed by some Conv2D or Dense layer (its masked kernel
+is nonzero). Channels of model inputs and outputs are always kept.
+
+Zero channels that BatchNorm turns into a nonzero constant are produced by it,
+so they're kept and the model computes the same function after the surgery.
+Constants are followed through activations, so a channel that ReLU turns back
+into zeros (its constant isn't positive) is removed. Positive constants aren't
+folded into biases of the consuming layers, their channels are kept.
+`shrink_model` reports the largest difference of outputs on random inputs.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from modules.pruning import sparse_layers
+from modules.tf_helper import models
+
+try:
+    from ._initialize import *
+except ImportError:
+    pass
+
+# `globally_enable_pruning` replaces classes in `tf.keras.layers`
+CONV_LAYERS = (sparse_layers.MaskedConv, sparse_layers.MaskedConv.__base__)
+DENSE_LAYERS = (sparse_layers.MaskedDense, sparse_layers.MaskedDense.__base__)
+
+# layers that keep the channels of their input
+CHANNELWISE_LAYERS = (
+    tf.keras.layers.ReLU,
+    tf.keras.layers.Activation,
+    tf.keras.layers.Dropout,
+    tf.keras.layers.MaxPool2D,
+    tf.keras.layers.AvgPool2D,
+    tf.keras.layers.GlobalMaxPool2D,
+    tf.keras.layers.GlobalAvgPool2D,
+    tf.keras.layers.ZeroPadding2D,
+    models.GemPool,
+)
+CHANNELWISE_OPS = ('nn.relu', 'nn.relu6', 'nn.elu', 'nn.selu', 'nn.swish', 'nn.silu',
+                   'nn.leaky_relu', 'math.sigmoid', 'math.tanh')
+ADD_OPS = ('__operators__.add', 'math.add')
+
+
+class ChannelGraph:
+    """Union-find over channel ids with flags for produced and consumed channels."""
+
+    def __init__(self):
+        self.parent = []
+        self.produced = []
+        self.consumed = []
+        self.tensor2ids = {}
+        self.tensor2constants = {}
+
+    def new_ids(self, produced):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + len(produced)))
+        self.produced.extend(produced)
+        self.consumed.extend([False] * len(produced))
+        return np.arange(start, start + len(produced))
+
+    def find(self, idx):
+        root = idx
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[idx] != root:
+            self.parent[idx], idx = root, self.parent[idx]
+        return root
+
+    def join(self, ids1, ids2):
+        assert len(ids1) == len(ids2), "Joined tensors have different channels!"
+        for i1, i2 in zip(ids1, ids2):
+            r1, r2 = self.find(i1), self.find(i2)
+            if r1 != r2:
+                self.parent[r2] = r1
+                self.produced[r1] |= self.produced[r2]
+                self.consumed[r1] |= self.consumed[r2]
+
+    def consume(self, ids, consumed=None):
+        if consumed is None:
+            consumed = np.ones(len(ids), dtype=bool)
+        for idx, c in zip(ids, consumed):
+            self.consumed[self.find(idx)] |= bool(c)
+
+    def produce(self, ids):
+        for idx in ids:
+            self.produced[self.find(idx)] = True
+
+    def get_ids(self, tensor):
+        return self.tensor2ids[id(tensor)]
+
+    def set_ids(self, tensor, ids, constants=None):
+        self.tensor2ids[id(tensor)] = ids
+        if constants is not None:
+            self.tensor2constants[id(tensor)] = constants
+
+    def get_constants(self, tensor):
+        """Values of channels of `tensor` that aren't produced, one row per case."""
+        default = np.zeros((1, len(self.get_ids(tensor))), dtype=np.float32)
+        return self.tensor2constants.get(id(tensor), default)
+
+    def produce_constants(self, tensor):
+        """Marks channels of `tensor` as produced if they're nonzero constants."""
+        nonzero = np.any(self.get_constants(tensor) != 0, axis=0)
+        self.produce(self.get_ids(tensor)[nonzero])
+
+    def keep(self, tensor):
+        roots = [self.find(idx) for idx in self.get_ids(tensor)]
+        return np.array([self.produced[r] and self.consumed[r] for r in roots],
+                        dtype=bool)
+
+
+def get_masked_kernel(layer):
+    kernel = layer.kernel.numpy()
+    if hasattr(layer, 'kernel_mask'):
+        kernel = kernel * layer.kernel_mask.numpy().astype(kernel.dtype)
+    return kernel
+
+
+def get_produced_channels(layer):
+    kernel = get_masked_kernel(layer)
+    produced = np.any(kernel.reshape(-1, kernel.shape[-1]) != 0, axis=0)
+    if layer.use_bias:
+        produced |= layer.bias.numpy() != 0
+
+    # dead channels stay zeros only if activation keeps zeros
+    if tf.reduce_any(layer.activation(tf.zeros(1)) != 0):
+        produced[:] = True
+    return produced
+
+
+def get_consumed_channels(layer):
+    kernel = get_masked_kernel(layer)
+    kernel = np.moveaxis(kernel, -2, 0)
+    return np.any(kernel.reshape(kernel.shape[0], -1) != 0, axis=1)
+
+
+def get_normalized_constants(layer, constants):
+    """Values that BatchNorm gives to constant channels."""
+
+    beta = layer.beta.numpy() if layer.center else 0.0
+    gamma = layer.gamma.numpy() if layer.scale else 1.0
+    mean = layer.moving_mean.numpy()
+    variance = layer.moving_variance.numpy()
+    normalized = (constants - mean) * gamma / np.sqrt(variance + layer.epsilon) + beta
+    # in training, a constant channel is its own mean and beta is its value
+    trained = np.broadcast_to(beta, constants.shape[1:])[None]
+    return np.concatenate([normalized, trained]).astype(np.float32)
+
+
+def get_activated_constants(layer, constants):
+    """Values that a channelwise layer gives to constant channels."""
+
+    if isinstance(layer, tf.keras.layers.ZeroPadding2D):
+        return np.concatenate([constants, np.zeros_like(constants[:1])])
+    elif isinstance(layer, (tf.keras.layers.ReLU, tf.keras.layers.Activation)):
+        activated = layer(tf.constant(constants))
+    elif getattr(layer, 'symbol', None) in CHANNELWISE_OPS:
+        activated = layer.function(tf.constant(constants))
+    else:  # pooling and dropout
+        return constants
+    return tf.cast(activated, tf.float32).numpy()
+
+
+def get_tensors(x):
+    return tf.nest.flatten(x)
+
+
+def build_channel_graph(model):
+    graph = ChannelGraph()
+    for inp in model.inputs:
+        ids = graph.new_ids([True] * inp.shape[-1])
+        graph.consume(ids)
+        graph.set_ids(inp, ids)
+
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.InputLayer):
+            continue
+        inputs = get_tensors(layer.input)
+        outputs = get_tensors(layer.output)
+        assert len(outputs) == 1, f"Layer {layer.name} has many outputs!"
+        name = getattr(layer, 'symbol', None)
+
+        if type(layer) in CONV_LAYERS + DENSE_LAYERS:
+            assert type(layer) in DENSE_LAYERS or layer.groups == 1
+            in_ids = graph.get_ids(inputs[0])
+            graph.produce_constants(inputs[0])
+            graph.consume(in_ids, get_consumed_channels(layer))
+            graph.set_ids(outputs[0], graph.new_ids(get_produced_channels(layer)))
+        elif isinstance(layer, tf.keras.layers.BatchNormalization):
+            constants = graph.get_constants(inputs[0])
+            graph.set_ids(outputs[0], graph.get_ids(inputs[0]),
+                          get_normalized_constants(layer, constants))
+        elif isinstance(layer, CHANNELWISE_LAYERS) or name in CHANNELWISE_OPS:
+            constants = graph.get_constants(inputs[0])
+            graph.set_ids(outputs[0], graph.get_ids(inputs[0]),
+                          get_activated_constants(layer, constants))
+        elif isinstance(layer, tf.keras.layers.Add) or name in ADD_OPS:
+            ids = graph.get_ids(inputs[0])
+            for inp in inputs:
+                graph.produce_constants(inp)
+            for inp in inputs[1:]:
+                graph.join(ids, graph.get_ids(inp))
+            graph.set_ids(outputs[0], ids)
+        elif isinstance(layer, tf.keras.layers.Concatenate):
+            assert layer.axis in (-1, len(outputs[0].shape) - 1)
+            for inp in inputs:
+                graph.produce_constants(inp)
+            ids = np.concatenate([graph.get_ids(inp) for inp in inputs])
+            graph.set_ids(outputs[0], ids)
+        elif isinstance(layer, tf.keras.layers.Flatten):
+            graph.produce_constants(inputs[0])
+            # flattened (H, W, C) has the channel index as the fastest one
+            spatial = np.prod(inputs[0].shape[1:-1], dtype=int)
+            graph.set_ids(outputs[0], np.tile(graph.get_ids(inputs[0]), spatial))
+        else:
+            raise NotImplementedError(f"Surgery of {layer.name} is not supported!")
+
+    for out in model.outputs:
+        graph.consume(graph.get_ids(out))
+        graph.produce(graph.get_ids(out))
+    return graph
+
+
+def copy_layer(layer, **changes):
+    """New layer with the config of `layer` updated by `changes`, without weights."""
+
+    config = layer.get_config()
+    config.update(changes)
+    return layer.__class__.from_config(config)
+
+
+def clone_layer(layer, graph):
+    if type(layer) in CONV_LAYERS:
+        return copy_layer(layer, filters=int(np.sum(graph.keep(layer.output))))
+    elif type(layer) in DENSE_LAYERS:
+        return copy_layer(layer, units=int(np.sum(graph.keep(layer.output))))
+    return copy_layer(layer)
+
+
+def slice_weights(layer, graph):
+    weights = layer.get_weights()
+    if type(layer) in CONV_LAYERS + DENSE_LAYERS:
+        in_keep = graph.keep(get_tensors(layer.input)[0])
+        out_keep = graph.keep(layer.output)
+        sliced = []
+        for w in weights:
+            if w.ndim >= 2:  # kernel or kernel mask
+                w = w[..., in_keep, :][..., out_keep]
+            else:
+                w = w[out_keep]
+            sliced.append(w)
+        return sliced
+    elif isinstance(layer, tf.keras.layers.BatchNormalization):
+        in_keep = graph.keep(get_tensors(layer.input)[0])
+        return [w[in_keep] for w in weights]
+    return weights
+
+
+def get_output_drift(model, new_model, batch_size=8):
+    """Largest absolute difference of outputs of both models on random inputs."""
+
+    inputs = [tf.random.normal((batch_size, *inp.shape[1:])) for inp in model.inputs]
+    if len(inputs) == 1:
+        inputs = inputs[0]
+    outputs = tf.nest.flatten(model(inputs, training=False))
+    new_outputs = tf.nest.flatten(new_model(inputs, training=False))
+    return max(float(tf.reduce_max(tf.abs(tf.cast(out, tf.float32) -
+                                          tf.cast(new_out, tf.float32))))
+               for out, new_out in zip(outputs, new_outputs))
+
+
+def shrink_model(model, silent=False):
+    """
+    :param model: functional model with pruned kernels
+    :param silent: if False, print number of kept channels of every layer
+    :return: new, smaller model with weights copied from `model`
+    """
+    graph = build_channel_graph(model)
+    prunable = [l for l in model.layers if type(l) in CONV_LAYERS + DENSE_LAYERS]
+
+    for layer in prunable:
+        if not graph.keep(layer.output).any():
+            raise ValueError(f"All channels of {layer.name} are pruned!")
+
+    new_model = tf.keras.models.clone_model(
+        model, clone_function=lambda layer: clone_layer(layer, graph))
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.InputLayer) or not layer.weights:
+            continue
+        new_layer = new_model.get_layer(layer.name)
+        new_layer.set_weights(slice_weights(layer, graph))
+
+        if not silent and layer in prunable:
+            keep = graph.keep(layer.output)
+            print(f"{layer.name:<32} keeping {keep.sum():>5} of {keep.size:>5} channels")
+    sparse_layers.count_masks(new_model)
+
+    if not silent:
+        print(f"SURGERY: {model.count_params()} -> {new_model.count_params()} parameters")
+        print(f"SURGERY: max output drift {get_output_drift(model, new_model):.3e}")
+    return new_model
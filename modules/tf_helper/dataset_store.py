@@ -0,0 +1,195 @@
+"""Datasets converted once to uint8 `.npy` arrays and then loaded memory-mapped.
+
+Layout of the store is `store_dir/name/split_images.npy` and `split_labels.npy`.
+All experiments on one host share the page-cached arrays instead of decoding
+TFRecords separately. Shuffling permutes indices, images are never copied
+except for the gathered batches. Metadata is in `store_dir/name/metadata.json`.
+
+Usage: python -m modules.tf_helper.dataset_store cifar10 store_dir [data_dir]
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+try:
+    from ._initialize import *
+except ImportError:
+    pass
+
+SUPPORTED = ('cifar10', 'cifar100', 'mnist')
+
+
+def get_path(store_dir, name):
+    return os.path.join(store_dir, name)
+
+
+def get_info_metadata(name, info):
+    """
+    :param name: name of the dataset
+    :param info: `tfds.core.DatasetInfo` of the dataset
+    :return: dict with `name`, `input_shape`, `n_classes`, `split_sizes` and `dtype`
+    """
+    return {
+        'name': name,
+        'input_shape': list(info.features['image'].shape),
+        'n_classes': int(info.features['label'].num_classes),
+        'split_sizes': {split: int(info.splits[split].num_examples)
+                        for split in info.splits},
+        'dtype': tf.as_dtype(info.features['image'].dtype).name,
+    }
+
+
+def save_metadata(path, metadata):
+    temp_path = f'{path}.tmp-{os.getpid()}'
+    with open(temp_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def load_metadata(name, store_dir):
+    """
+    :param name: name of a converted dataset
+    :param store_dir: directory of the store
+    :return: metadata like in `get_info_metadata`, read without touching the data
+    """
+    path = os.path.join(get_path(store_dir, name), 'metadata.json')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    # store converted without metadata, labels are small enough to be scanned once
+    metadata = {'name': name, 'split_sizes': {}, 'n_classes': 0}
+    for split in ('train', 'test'):
+        images, labels = load_split(store_dir, name, split)
+        metadata['input_shape'] = list(images.shape[1:])
+        metadata['dtype'] = images.dtype.name
+        metadata['split_sizes'][split] = len(labels)
+        metadata['n_classes'] = max(metadata['n_classes'], int(labels.max()) + 1)
+    save_metadata(path, metadata)
+    return metadata
+
+
+def convert(name, store_dir, data_dir=None, chunk_size=10000):
+    """
+    :param name: one of `SUPPORTED`
+    :param store_dir: directory of the store
+    :param data_dir: directory of tensorflow_datasets
+    :param chunk_size: number of examples decoded at once
+    :return: path to the converted dataset
+    """
+    if name not in SUPPORTED:
+        raise KeyError(f"Dataset {name} is unknown!")
+    path = get_path(store_dir, name)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(store_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=store_dir, prefix='.tmp-')
+    ds, info = tfds.load(name=name, as_supervised=True, data_dir=data_dir, with_info=True)
+    for split, split_ds in ds.items():
+        num_examples = info.splits[split].num_examples
+        image_shape = info.features['image'].shape
+        images = np.lib.format.open_memmap(os.path.join(temp_path, f'{split}_images.npy'),
+                                           mode='w+', dtype=np.uint8,
+                                           shape=(num_examples, *image_shape))
+        labels = np.lib.format.open_memmap(os.path.join(temp_path, f'{split}_labels.npy'),
+                                           mode='w+', dtype=np.int64,
+                                           shape=(num_examples,))
+        start = 0
+        for x, y in tfds.as_numpy(split_ds.batch(chunk_size)):
+            images[start:start + len(y)] = x
+            labels[start:start + len(y)] = y
+            start += len(y)
+        assert start == num_examples, f"Split {split} has {start} examples!"
+        images.flush()
+        labels.flush()
+        del images, labels
+    save_metadata(os.path.join(temp_path, 'metadata.json'), get_info_metadata(name, info))
+
+    try:
+        os.rename(temp_path, path)  # atomic, concurrent runs can't see half a dataset
+    except OSError:
+        shutil.rmtree(temp_path)  # other run has just converted the same dataset
+    print(f"CONVERTED {name} TO {path}")
+    return path
+
+
+def load_split(store_dir, name, split):
+    """
+    :return: memory-mapped uint8 images and int64 labels
+    """
+    path = get_path(store_dir, name)
+    images = np.load(os.path.join(path, f'{split}_images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(path, f'{split}_labels.npy'), mmap_mode='r')
+    return images, labels
+
+
+def iterate_batches(images, labels, batch_size, shuffle=False, seed=None):
+    """
+    :param images: array from `load_split`
+    :param labels: array from `load_split`
+    :param batch_size: size of batches, the last one might be smaller
+    :param shuffle: if True, examples are in random order
+    :param seed: seed of the random order
+    :return: generator of NumPy batches, single pass over the data
+    """
+    indices = np.arange(len(labels))
+    if shuffle:
+        indices = np.random.default_rng(seed).permutation(indices)
+    for start in range(0, len(indices), batch_size):
+        idx = indices[start:start + batch_size]
+        yield images[idx], labels[idx]
+
+
+def to_dataset(images, labels, shuffle=False, chunk_size=1024):
+    """
+    :param images: array from `load_split`
+    :param labels: array from `load_split`
+    :param shuffle: if True, examples are in new random order every iteration
+    :param chunk_size: number of examples gathered from the arrays at once
+    :return: unbatched tf.data.Dataset of (uint8 image, label), like `tfds.load`
+    """
+    num_examples = len(labels)
+
+    def gather(idx):
+        return images[idx], labels[idx]
+
+    def gather_tf(idx):
+        x, y = tf.numpy_function(gather, [idx], (tf.uint8, tf.int64))
+        x.set_shape((None, *images.shape[1:]))
+        y.set_shape((None,))
+        return x, y
+
+    ds = tf.data.Dataset.range(num_examples)
+    if shuffle:
+        ds = ds.shuffle(num_examples, reshuffle_each_iteration=True)
+    ds = ds.batch(chunk_size)
+    ds = ds.map(gather_tf, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.unbatch()
+
+
+def load(name, store_dir, data_dir=None, shuffle_train=True):
+    """
+    :param name: one of `SUPPORTED`
+    :param store_dir: directory of the store, dataset is converted if it's missing
+    :param data_dir: directory of tensorflow_datasets, used only for the conversion
+    :param shuffle_train: if True, training examples are shuffled every iteration
+    :return: dict of unbatched datasets, like `tfds.load(..., as_supervised=True)`
+    """
+    convert(name, store_dir, data_dir)
+    ds = {}
+    for split in ('train', 'test'):
+        images, labels = load_split(store_dir, name, split)
+        ds[split] = to_dataset(images, labels, shuffle=shuffle_train and split == 'train')
+    return ds
+
+
+if __name__ == '__main__':
+    convert(*sys.argv[1:])
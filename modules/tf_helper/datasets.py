@@ -1,6 +1,91 @@
+import json
+import os
+
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
+from modules.tf_helper import dataset_store
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+_metadata = {}
+
+
+def set_pipeline_options(ds, deterministic=True, threadpool_size=None,
+                         intra_op_parallelism=None):
+    """
+    :param ds: tf.data.Dataset
+    :param deterministic: if False, parallel maps can return elements out of order
+    :param threadpool_size: if given, the dataset uses its own pool of threads
+    :param intra_op_parallelism: if given, max threads used by a single op
+    :return: tf.data.Dataset with the options set
+    """
+    options = tf.data.Options()
+    options.experimental_deterministic = deterministic
+    threading = getattr(options, 'threading', None) or options.experimental_threading
+    if threadpool_size:
+        threading.private_threadpool_size = threadpool_size
+    if intra_op_parallelism:
+        threading.max_intra_op_parallelism = intra_op_parallelism
+    return ds.with_options(options)
+
+
+def random_crop_batch(x, height, width):
+    """Crops every image of the batch `x` at its own random offset."""
+
+    shape = tf.shape(x)
+    dy = tf.random.uniform([shape[0], 1], 0, shape[1] - height + 1, dtype=tf.int32)
+    dx = tf.random.uniform([shape[0], 1], 0, shape[2] - width + 1, dtype=tf.int32)
+    x = tf.gather(x, dy + tf.range(height), axis=1, batch_dims=1)
+    x = tf.gather(x, dx + tf.range(width), axis=2, batch_dims=1)
+    return x
+
+
+def load(name, data_dir=None, store_dir=None, shuffle_train=True):
+    """Unbatched uint8 splits from `tensorflow_datasets` or from `dataset_store`."""
+
+    if store_dir:
+        return dataset_store.load(name, store_dir, data_dir, shuffle_train)
+    return tfds.load(name=name, as_supervised=True, data_dir=data_dir)
+
+
+def get_metadata(name, data_dir=None, store_dir=None):
+    """
+    :param name: name of the dataset in `tensorflow_datasets`
+    :param data_dir: directory of tensorflow_datasets
+    :param store_dir: if given, metadata is read from `dataset_store`
+    :return: dict with `name`, `input_shape`, `n_classes`, `split_sizes` and `dtype`
+
+    Metadata comes from the store or from the builder info and the data isn't read.
+    It's memoized and, if `data_dir` is given, cached there as JSON.
+    """
+    key = (name, data_dir, store_dir)
+    if key in _metadata:
+        return _metadata[key]
+
+    if store_dir:
+        metadata = dataset_store.load_metadata(name, store_dir)
+    else:
+        path = os.path.join(data_dir, f'{name}.metadata.json') if data_dir else None
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                metadata = json.load(f)
+        else:
+            info = tfds.builder(name, data_dir=data_dir).info
+            metadata = dataset_store.get_info_metadata(name, info)
+            if path:
+                dataset_store.save_metadata(path, metadata)
+    _metadata[key] = metadata
+    return metadata
+
+
+def add_metadata(ds, name, data_dir=None, store_dir=None):
+    metadata = get_metadata(name, data_dir, store_dir)
+    ds['metadata'] = metadata
+    ds['input_shape'] = tuple(metadata['input_shape'])
+    ds['n_classes'] = metadata['n_classes']
+    return ds
+
 
 def cifar(train_batch_size=128,
           valid_batch_size=512,
@@ -9,7 +94,19 @@ def cifar(train_batch_size=128,
           shuffle_train=20000,
           repeat_train=True,
           version=10,
-          data_dir=None):
+          data_dir=None,
+          fast=False,
+          deterministic=True,
+          threadpool_size=None,
+          intra_op_parallelism=None,
+          store_dir=None):
+    """
+    With `store_dir`, data is loaded memory-mapped from `dataset_store`.
+    With `fast`, decoded uint8 images are cached in memory and augmentation runs
+    in parallel on whole batches. `deterministic`, `threadpool_size` and
+    `intra_op_parallelism` are used only with `fast`, see `set_pipeline_options`.
+    Data from the store isn't cached again, it's in the page cache already.
+    """
     subtract = tf.constant([0.49139968, 0.48215841, 0.44653091], dtype=dtype)
     divide = tf.constant([0.24703223, 0.24348513, 0.26158784], dtype=dtype)
 
@@ -21,15 +118,49 @@ def cifar(train_batch_size=128,
         x = (x - subtract) / divide
         return x, y
 
+    def train_prep_batch(x, y):
+        x = tf.cast(x, dtype) / 255.0
+        flip = tf.random.uniform([tf.shape(x)[0], 1, 1, 1]) < 0.5
+        x = tf.where(flip, tf.reverse(x, axis=[2]), x)
+        x = tf.pad(x, [[0, 0], [4, 4], [4, 4], [0, 0]], mode=padding)
+        x = random_crop_batch(x, 32, 32)
+        x = (x - subtract) / divide
+        return x, y
+
     def valid_prep(x, y):
         x = tf.cast(x, dtype) / 255.0
         x = (x - subtract) / divide
         return x, y
 
     if version == 10 or version == 100:
-        ds = tfds.load(name=f'cifar{version}', as_supervised=True, data_dir=data_dir)
+        ds = load(f'cifar{version}', data_dir, store_dir, bool(shuffle_train))
     else:
         raise Exception(f"version = {version}, but should be either 10 or 100!")
+    add_metadata(ds, f'cifar{version}', data_dir, store_dir)
+    if store_dir:
+        shuffle_train = None  # store shuffles by index permutation
+
+    if fast:
+        if not store_dir:
+            ds['train'] = ds['train'].cache()
+        if repeat_train:
+            ds['train'] = ds['train'].repeat()
+        if shuffle_train:
+            ds['train'] = ds['train'].shuffle(shuffle_train)
+        ds['train'] = ds['train'].batch(train_batch_size)
+        ds['train'] = ds['train'].map(train_prep_batch, num_parallel_calls=AUTOTUNE)
+        ds['train'] = ds['train'].prefetch(AUTOTUNE)
+
+        if not store_dir:
+            ds['test'] = ds['test'].cache()
+        ds['test'] = ds['test'].batch(valid_batch_size)
+        ds['test'] = ds['test'].map(valid_prep, num_parallel_calls=AUTOTUNE)
+        ds['test'] = ds['test'].prefetch(AUTOTUNE)
+
+        for split in ('train', 'test'):
+            ds[split] = set_pipeline_options(ds[split], deterministic, threadpool_size,
+                                             intra_op_parallelism)
+        return ds
 
     if repeat_train:
         ds['train'] = ds['train'].repeat()
@@ -48,23 +179,51 @@ def mnist(train_batch_size=100,
           valid_batch_size=400,
           dtype=tf.float32,
           shuffle_train=10000,
-          data_dir=None):
+          data_dir=None,
+          fast=False,
+          deterministic=True,
+          threadpool_size=None,
+          intra_op_parallelism=None,
+          store_dir=None):
+    """Arguments after `data_dir` work the same as in `cifar`."""
+
     def preprocess(x, y):
         x = tf.cast(x, dtype)
         x /= 255
         return x, y
 
-    ds = tfds.load(name='mnist', as_supervised=True, data_dir=data_dir)
-    ds['train'] = ds['train'].repeat()
-    ds['train'] = ds['train'].shuffle(shuffle_train)
-    ds['train'] = ds['train'].map(preprocess)
-    ds['train'] = ds['train'].batch(train_batch_size)
+    ds = load('mnist', data_dir, store_dir, bool(shuffle_train))
+    add_metadata(ds, 'mnist', data_dir, store_dir)
+    if store_dir:
+        shuffle_train = None  # store shuffles by index permutation
 
-    ds['test'] = ds['test'].map(preprocess)
-    ds['test'] = ds['test'].batch(valid_batch_size)
+    if fast:
+        if not store_dir:
+            ds['train'] = ds['train'].cache()
+            ds['test'] = ds['test'].cache()
+        ds['train'] = ds['train'].repeat()
+        if shuffle_train:
+            ds['train'] = ds['train'].shuffle(shuffle_train)
+        ds['train'] = ds['train'].batch(train_batch_size)
+        ds['train'] = ds['train'].map(preprocess, num_parallel_calls=AUTOTUNE)
+        ds['train'] = ds['train'].prefetch(AUTOTUNE)
+
+        ds['test'] = ds['test'].batch(valid_batch_size)
+        ds['test'] = ds['test'].map(preprocess, num_parallel_calls=AUTOTUNE)
+        ds['test'] = ds['test'].prefetch(AUTOTUNE)
+
+        for split in ('train', 'test'):
+            ds[split] = set_pipeline_options(ds[split], deterministic, threadpool_size,
+                                             intra_op_parallelism)
+    else:
+        ds['train'] = ds['train'].repeat()
+        if shuffle_train:
+            ds['train'] = ds['train'].shuffle(shuffle_train)
+        ds['train'] = ds['train'].map(preprocess)
+        ds['train'] = ds['train'].batch(train_batch_size)
 
-    ds['input_shape'] = (28, 28, 1)
-    ds['n_classes'] = 10
+        ds['test'] = ds['test'].map(preprocess)
+        ds['test'] = ds['test'].batch(valid_batch_size)
     return ds
 
 
@@ -83,6 +242,76 @@ def test(train_batch_size=100,
     ds['train'] = ds['train'].map(preprocess).repeat().batch(train_batch_size)
     ds['test'] = tf.data.Dataset.from_tensor_slices((images, target))
     ds['test'] = ds['test'].map(preprocess).batch(2)
+    ds['input_shape'] = tuple(image_shape)
+    ds['n_classes'] = 2
+    return ds
+
+
+# input shape, number of classes and split sizes of datasets imitated by `synthetic`
+SYNTHETIC_SHAPES = {
+    'cifar10': ((32, 32, 3), 10, {'train': 50000, 'test': 10000}),
+    'cifar100': ((32, 32, 3), 100, {'train': 50000, 'test': 10000}),
+    'mnist': ((28, 28, 1), 10, {'train': 60000, 'test': 10000}),
+    'imagenet': ((224, 224, 3), 1000, {'train': 1281167, 'test': 50000}),
+}
+
+
+def synthetic(train_batch_size=128,
+              valid_batch_size=512,
+              imitate='cifar10',
+              n_classes=None,
+              n_examples=None,
+              decode_cost=0,
+              dtype=tf.float32,
+              seed=0):
+    """
+    :param imitate: key of `SYNTHETIC_SHAPES`, dataset which shapes are used
+    :param n_classes: if given, overrides the number of classes
+    :param n_examples: if given, overrides the number of training examples
+    :param decode_cost: number of elementwise passes over every image, simulates
+                        the cost of decoding and augmentation
+    :param seed: images are the same in every epoch for the same seed
+
+    Random images with 256 levels, scaled to [0, 1] in `dtype`, and labels are
+    generated batch by batch, nothing is read from the disk. Useful to benchmark
+    training or pruning in isolation.
+    """
+    if imitate not in SYNTHETIC_SHAPES:
+        raise KeyError(f"Dataset {imitate} is unknown!")
+    image_shape, default_n_classes, split_sizes = SYNTHETIC_SHAPES[imitate]
+    n_classes = n_classes or default_n_classes
+    split_sizes = {**split_sizes, 'train': n_examples or split_sizes['train']}
+
+    def generate(idx, split_seed):
+        batch_seed = tf.stack([tf.cast(split_seed, tf.int64), idx[0]])
+        x = tf.random.stateless_uniform([tf.size(idx), *image_shape], seed=batch_seed,
+                                        maxval=256, dtype=tf.int32)
+        y = tf.random.stateless_uniform([tf.size(idx)], seed=batch_seed + 1,
+                                        maxval=n_classes, dtype=tf.int64)
+        x = tf.cast(x, tf.float32)
+        for _ in range(decode_cost):
+            x = tf.round(tf.sqrt(tf.square(x)))  # keeps the values, costs the time
+        x = tf.cast(x, dtype) / 255
+        return x, y
+
+    ds = dict()
+    for split, batch_size, split_seed in (('train', train_batch_size, 2 * seed),
+                                          ('test', valid_batch_size, 2 * seed + 1)):
+        ds[split] = tf.data.Dataset.range(split_sizes[split]).batch(batch_size)
+        ds[split] = ds[split].map(lambda idx, s=split_seed: generate(idx, s),
+                                  num_parallel_calls=AUTOTUNE)
+    ds['train'] = ds['train'].repeat().prefetch(AUTOTUNE)
+    ds['test'] = ds['test'].prefetch(AUTOTUNE)
+
+    ds['metadata'] = {
+        'name': f'synthetic_{imitate}',
+        'input_shape': list(image_shape),
+        'n_classes': n_classes,
+        'split_sizes': split_sizes,
+        'dtype': tf.as_dtype(dtype).name,
+    }
+    ds['input_shape'] = tuple(image_shape)
+    ds['n_classes'] = n_classes
     return ds
 
 
@@ -104,11 +333,15 @@ def get_dataset_from_alias(alias, precision=32):
         return cifar(dtype=dtype, version=100)
     elif alias == 'mnist':
         return mnist(dtype=dtype)
+    elif alias.startswith('synthetic_'):
+        return synthetic(dtype=dtype, imitate=alias[len('synthetic_'):])
     else:
         raise NotImplementedError(f"Unknown alias {alias}")
 
 
 def figure_out_input_shape(ds):
+    if 'input_shape' in ds:
+        return ds['input_shape']
     for x, y in ds['test']:
         break
     else:
@@ -117,6 +350,8 @@ def figure_out_input_shape(ds):
 
 
 def figure_out_n_classes(ds):
+    if 'n_classes' in ds:
+        return ds['n_classes']
     classes = set()
     for x, y in ds['test']:
         classes.update(y.numpy())
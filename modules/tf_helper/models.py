@@ -10,11 +10,16 @@ except ImportError:
 
 
 class GemPool(tf.keras.layers.Layer):
-    def __init__(self, pool_size=None, initial_value=3.0):
-        super().__init__()
+    def __init__(self, pool_size=None, initial_value=3.0, **kwds):
+        super().__init__(**kwds)
         self.initial_value = initial_value
         self.pool = pool_size
 
+    def get_config(self):
+        config = super().get_config()
+        config.update(pool_size=self.pool, initial_value=self.initial_value)
+        return config
+
     def call(self, flow, **kwds):
         input_dtype = flow.dtype
         flow = tf.cast(flow, tf.float32)
@@ -1,5 +1,6 @@
 import os
 import pickle
+import time
 from collections import Counter, abc
 from copy import deepcopy
 
@@ -128,6 +129,77 @@ def concatenate_flattened(arrays):
                            else x.numpy().flatten() for x in arrays], axis=0)
 
 
+def count_flops(layer, output_shape, nonzero=None):
+    """
+    :param layer: built layer of a functional model
+    :param output_shape: shape of the layer's output without the batch dimension
+    :param nonzero: number of unpruned kernel weights, all of them if None
+    :return: FLOPs for a single example, multiply-add counts as 2 FLOPs
+    """
+    outputs = int(np.prod(output_shape))
+    input_shape = tf.nest.flatten(layer.input)[0].shape[1:]
+    inputs = int(np.prod(input_shape))
+
+    if hasattr(layer, 'kernel') and len(layer.kernel.shape) in (2, 4):  # Dense or Conv2D
+        weights = layer.kernel.shape.num_elements() if nonzero is None else nonzero
+        positions = outputs // output_shape[-1]  # also 1 for Dense
+        flops = 2 * positions * weights
+        if layer.use_bias:
+            flops += outputs
+        return flops
+    if isinstance(layer, tf.keras.layers.BatchNormalization):
+        return 2 * outputs  # scale and shift in inference
+    if isinstance(layer, (tf.keras.layers.MaxPool2D, tf.keras.layers.AvgPool2D)):
+        return outputs * int(np.prod(layer.pool_size))
+    if isinstance(layer, (tf.keras.layers.GlobalMaxPool2D,
+                          tf.keras.layers.GlobalAvgPool2D)):
+        return inputs
+    if layer.__class__.__name__ == 'GemPool':
+        return 3 * inputs  # clip, power and pooling
+    if isinstance(layer, tf.keras.layers.InputLayer):
+        return 0
+    return outputs  # elementwise operations
+
+
+def profile_model(model, batch_size=1):
+    """
+    :param model: built functional model
+    :param batch_size: batch size used for the activation memory
+    :return: list of dicts, one per layer, with `name`, `dense_flops`, `sparse_flops`,
+             `activation_bytes` and `param_bytes`; FLOPs are for the whole batch
+
+    Sparse FLOPs of layers with `kernel_mask` count only unpruned weights.
+    """
+    from modules.pruning import sparse_layers
+
+    masked = [l for l in model.layers if hasattr(l, 'kernel_mask')]
+    name2nonzero = {l.name: int(nonzero)
+                    for l, nonzero in zip(masked, sparse_layers.count_nonzero(masked))}
+
+    rows = []
+    for layer in model.layers:
+        nonzero = name2nonzero.get(layer.name)
+
+        activation_bytes = 0
+        dense_flops = sparse_flops = 0
+        for output in tf.nest.flatten(layer.output):
+            output_shape = output.shape[1:]
+            dense_flops += batch_size * count_flops(layer, output_shape)
+            sparse_flops += batch_size * count_flops(layer, output_shape, nonzero)
+            activation_bytes += (batch_size * output_shape.num_elements()
+                                 * tf.as_dtype(output.dtype).size)
+
+        rows.append({
+            'name': layer.name,
+            'dense_flops': dense_flops,
+            'sparse_flops': sparse_flops,
+            'activation_bytes': activation_bytes,
+            'param_bytes': sum(w.shape.num_elements() * w.dtype.size
+                               for w in layer.weights),
+        })
+    return rows
+
+
 def print_model_info(model):
     print(f"MODEL INFO")
     layer_counts = Counter()
@@ -169,6 +241,24 @@ def print_model_info(model):
           f"BN: {bn} ({bn / trainable_w * 100:^6.2f}%)")
 
 
+def print_model_profile(model, batch_size=1):
+    """Prints `profile_model` of every layer and returns the totals."""
+
+    rows = profile_model(model, batch_size)
+    for row in rows:
+        print(f"{row['name']:<32} "
+              f"FLOPS {row['dense_flops']:>14,} -> {row['sparse_flops']:>14,} "
+              f"ACTIVATIONS {row['activation_bytes'] / 2 ** 20:9.3f} MB "
+              f"PARAMS {row['param_bytes'] / 2 ** 20:9.3f} MB")
+
+    totals = {key: sum(row[key] for row in rows) for key in rows[0] if key != 'name'}
+    print(f"BATCH SIZE {batch_size}: "
+          f"DENSE FLOPS {totals['dense_flops']:,}, "
+          f"SPARSE FLOPS {totals['sparse_flops']:,}, "
+          f"ACTIVATIONS {totals['activation_bytes'] / 2 ** 20:.3f} MB")
+    return totals
+
+
 def save_optimizer(optimizer, path):
     if dirpath := os.path.dirname(path):
         os.makedirs(dirpath, exist_ok=True)
@@ -228,6 +318,50 @@ class CheckpointAfterEpoch(tf.keras.callbacks.Callback):
             print(ckp)
 
 
+class StepTimer(tf.keras.callbacks.Callback):
+    """
+    Measures the first training call, which includes tracing and compilation,
+    separately from the mean time of the following steps. With many steps per
+    call, their number is read from `logs['num_steps']`.
+    """
+    # logs aren't read, so they don't have to be copied from the device every step
+    _supports_tf_logs = True
+    # works with any number of steps per call of the custom `fit`
+    required_interval = 0
+
+    def __init__(self):
+        super().__init__()
+        self.first_step_time = None
+        self.first_num_steps = 1
+        self.steady_time = 0.0
+        self.steady_steps = 0
+        self.t0 = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.t0 = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        elapsed = time.perf_counter() - self.t0
+        num_steps = (logs or {}).get('num_steps', 1)
+        if self.first_step_time is None:
+            self.first_step_time = elapsed
+            self.first_num_steps = num_steps
+        else:
+            self.steady_time += elapsed
+            self.steady_steps += num_steps
+
+    @property
+    def step_time(self):
+        return self.steady_time / self.steady_steps if self.steady_steps else None
+
+    @property
+    def compile_time(self):
+        if self.first_step_time is None:
+            return None
+        steady_time = self.first_num_steps * (self.step_time or 0.0)
+        return max(0.0, self.first_step_time - steady_time)
+
+
 def get_optimizer_lr_metric(opt):
     if hasattr(opt, '_decayed_lr'):
         def lr(*args):
@@ -1,6 +1,11 @@
 """Source created in notebook: notebooks\training_functools.ipynb"""
 
-from collections import defaultdict
+import functools
+import math
+import queue
+import threading
+import time
+from collections import defaultdict, deque
 from itertools import islice
 
 import tensorflow as tf
@@ -31,10 +36,153 @@ def train_step(x, y, model):
     return outs
 
 
+@functools.lru_cache(maxsize=None)
+def compile_with_xla(step):
+    """XLA compiled copy of `tf.function` `step`, created when first needed."""
+    return tf.function(step.python_function, jit_compile=True)
+
+
+def get_train_step(jit_compile=False):
+    return compile_with_xla(train_step) if jit_compile else train_step
+
+
+@tf.function
+def train_steps(iterator, model, num_steps, jit_compile=False):
+    """Runs `num_steps` of `train_step` in one call, returns number of examples."""
+
+    step = get_train_step(jit_compile)
+    num_examples = tf.constant(0)
+    for _ in tf.range(num_steps):
+        x, y = iterator.get_next()
+        step(x, y, model)
+        num_examples += tf.shape(x)[0]
+    return num_examples
+
+
+def uses_batch_hooks(callback):
+    cls = tf.keras.callbacks.Callback
+    return (
+        type(callback).on_train_batch_begin is not cls.on_train_batch_begin
+        or type(callback).on_train_batch_end is not cls.on_train_batch_end
+    )
+
+
+def get_steps_per_execution(steps_per_execution, callbacks=(), steps=None):
+    """
+    :param steps_per_execution: requested number of steps in one call
+    :param callbacks: callbacks with batch hooks can declare `required_interval`,
+                      they're called only every that many steps, otherwise every step,
+                      0 means any number of steps
+    :param steps: number of steps in epoch, if callbacks require an interval, calls
+                  don't cross epochs so steps counted by callbacks stay aligned
+    :return: largest number of steps in one call that every callback allows
+    """
+    is_aligned = False
+    for callback in callbacks:
+        if uses_batch_hooks(callback):
+            required_interval = getattr(callback, "required_interval", 1)
+            steps_per_execution = math.gcd(steps_per_execution, required_interval)
+            is_aligned |= required_interval != 0
+    if is_aligned and steps:
+        steps_per_execution = math.gcd(steps_per_execution, steps)
+    return steps_per_execution
+
+
 # %%
 
 
-def train_epoch(iterator, model, epoch_idx=0, steps=None, callbacks=(), use_pbar=None):
+class MetricsLogger:
+    """Shows metrics, step latency and images/s in the progress bar.
+
+    Reading metrics waits for the device, so it's done every `interval` steps.
+    The snapshot of metrics is taken on the training thread, so all values come
+    from the same step. With `background`, the snapshot is read in a separate
+    thread and the training loop doesn't wait for the device. If the thread is
+    still busy, the snapshot is skipped. Progress bar is only touched by the
+    training thread. Speed is averaged over last `window` readings.
+    """
+
+    def __init__(self, model, pbar, interval=1, background=False, window=10):
+        self.model = model
+        self.pbar = pbar
+        self.interval = max(1, interval)
+        self.last_step = -1
+        self.times = deque(maxlen=window + 1)
+        self.snapshots = queue.Queue(maxsize=1)
+        self.postfix = None
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.read_snapshots, daemon=True)
+            self.thread.start()
+
+    def get_latency(self, step):
+        self.times.append((step, time.perf_counter()))
+        (step0, t0), (step1, t1) = self.times[0], self.times[-1]
+        if step1 == step0:
+            return None
+        return (t1 - t0) / (step1 - step0)
+
+    @staticmethod
+    def get_postfix(snapshot, latency, batch_size):
+        postfix = {name: value.numpy() for name, value in snapshot.items()}
+        if latency:
+            postfix["step_ms"] = latency * 1000
+            postfix["images/s"] = float(batch_size) / latency
+        return postfix
+
+    def get_snapshot(self):
+        return {m.name: tf.identity(m.result()) for m in self.model.metrics}
+
+    def read_snapshots(self):
+        while (item := self.snapshots.get()) is not None:
+            self.postfix = self.get_postfix(*item)
+
+    def show_postfix(self):
+        postfix, self.postfix = self.postfix, None
+        if postfix is not None:
+            self.pbar.set_postfix(postfix, refresh=False)
+
+    def on_step_end(self, step, batch_size):
+        """`step` is index of the last finished step, `batch_size` can be a tensor."""
+
+        last_step, self.last_step = self.last_step, step
+        if (step + 1) // self.interval == (last_step + 1) // self.interval:
+            return
+        latency = self.get_latency(step + 1)
+        if self.thread is None:
+            self.postfix = self.get_postfix(self.get_snapshot(), latency, batch_size)
+        elif not self.snapshots.full():  # the only producer, so put won't block
+            self.snapshots.put_nowait((self.get_snapshot(), latency, batch_size))
+        self.show_postfix()
+
+    def close(self):
+        if self.thread is not None:
+            self.snapshots.put(None)
+            self.thread.join()
+        self.show_postfix()
+
+
+def train_epoch(
+    iterator,
+    model,
+    epoch_idx=0,
+    steps=None,
+    callbacks=(),
+    use_pbar=None,
+    log_interval=1,
+    log_in_background=False,
+    steps_per_execution=1,
+    jit_compile=False,
+):
+    """
+    `log_interval` and `log_in_background` are passed to `MetricsLogger`.
+    With `jit_compile`, training steps are compiled with XLA.
+
+    With `steps_per_execution`, that many steps run in one `tf.function` call and
+    callbacks get the number of steps in `logs["num_steps"]`. It's lowered to fit
+    `required_interval` of the callbacks, see `get_steps_per_execution`.
+    """
+
     for callback in callbacks:
         assert isinstance(callback, tf.keras.callbacks.Callback)
         callback.on_epoch_begin(epoch_idx)
@@ -43,22 +191,48 @@ def train_epoch(iterator, model, epoch_idx=0, steps=None, callbacks=(), use_pbar
         pbar = use_pbar
     else:
         pbar = tqdm(total=steps, leave=True, ascii=True)
+    logger = MetricsLogger(
+        model, pbar, interval=log_interval, background=log_in_background
+    )
 
-    for bidx, (x, y) in enumerate(islice(iterator, steps)):
-        for callback in callbacks:
-            assert isinstance(callback, tf.keras.callbacks.Callback)
-            callback.on_train_batch_begin(bidx)
+    steps_per_execution = get_steps_per_execution(steps_per_execution, callbacks, steps)
+    if steps_per_execution > 1:
+        assert steps is not None, "Number of steps required with steps_per_execution!"
+        data_iterator = iter(iterator)
+
+        for bidx in range(0, steps, steps_per_execution):
+            num_steps = min(steps_per_execution, steps - bidx)
+            logs = {"num_steps": num_steps}
+            for callback in callbacks:
+                assert isinstance(callback, tf.keras.callbacks.Callback)
+                callback.on_train_batch_begin(bidx, logs)
+
+            num_examples = train_steps(
+                data_iterator, model, tf.constant(num_steps), jit_compile
+            )
+            end_bidx = bidx + num_steps - 1
+            logger.on_step_end(end_bidx, batch_size=num_examples / num_steps)
+
+            for callback in callbacks:
+                assert isinstance(callback, tf.keras.callbacks.Callback)
+                callback.on_train_batch_end(end_bidx, logs)
+            pbar.update(num_steps)
+    else:
+        step = get_train_step(jit_compile)
+        for bidx, (x, y) in enumerate(islice(iterator, steps)):
+            for callback in callbacks:
+                assert isinstance(callback, tf.keras.callbacks.Callback)
+                callback.on_train_batch_begin(bidx)
 
-        outs = train_step(x, y, model)
-        pbar.set_postfix(
-            {m.name: m.result().numpy() for m in model.metrics}, refresh=False
-        )
+            outs = step(x, y, model)
+            logger.on_step_end(bidx, batch_size=x.shape[0])
 
-        for callback in callbacks:
-            assert isinstance(callback, tf.keras.callbacks.Callback)
-            callback.on_train_batch_end(bidx)
-        pbar.update()
+            for callback in callbacks:
+                assert isinstance(callback, tf.keras.callbacks.Callback)
+                callback.on_train_batch_end(bidx)
+            pbar.update()
 
+    logger.close()
     if not use_pbar:
         pbar.close()
 
@@ -82,13 +256,20 @@ def valid_step(x, y, model):
     return outs
 
 
-def valid_epoch(iterator, model, epoch_idx=0, steps=None, callbacks=()):
+def get_valid_step(jit_compile=False):
+    return compile_with_xla(valid_step) if jit_compile else valid_step
+
+
+def valid_epoch(
+    iterator, model, epoch_idx=0, steps=None, callbacks=(), jit_compile=False
+):
+    step = get_valid_step(jit_compile)
     for bidx, (x, y) in enumerate(islice(iterator, steps)):
         for callback in callbacks:
             assert isinstance(callback, tf.keras.callbacks.Callback)
             callback.on_test_batch_begin(bidx)
 
-        outs = valid_step(x, y, model)
+        outs = step(x, y, model)
 
         for callback in callbacks:
             assert isinstance(callback, tf.keras.callbacks.Callback)
@@ -113,6 +294,10 @@ def fit(
     epochs=1,
     initial_epoch=0,
     callbacks=(),
+    log_interval=1,
+    log_in_background=False,
+    steps_per_execution=1,
+    jit_compile=False,
 ):
     history = defaultdict(list)
 
@@ -126,6 +311,10 @@ def fit(
             steps=steps_per_epoch,
             callbacks=callbacks,
             use_pbar=pbar,
+            log_interval=log_interval,
+            log_in_background=log_in_background,
+            steps_per_execution=steps_per_execution,
+            jit_compile=jit_compile,
         )
         metrics = reset_metrics(model)
         for key, value in metrics.items():
@@ -137,6 +326,7 @@ def fit(
             epoch_idx=epoch_idx,
             steps=steps_per_epoch,
             callbacks=callbacks,
+            jit_compile=jit_compile,
         )
         metrics = reset_metrics(model)
         for key, value in metrics.items():
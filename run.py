@@ -49,6 +49,9 @@ for exp_idx, exp in enumerate(experiment_queue):
     print()
     print(f"NEW EXPERIMENT {exp_idx} / {len(experiment_queue)}:\n{exp}")
 
+    if exp.get('ClearSolved'):
+        print("CLEARING OBJECTS SOLVED ONCE")
+        parser.clear_solved_cache()
     solved_exp = parser.solve_python_objects(deepcopy(exp))
     if backup_diff := solved_exp.difference(exp):
         solved_diff = exp.difference(solved_exp)
@@ -63,7 +66,7 @@ for exp_idx, exp in enumerate(experiment_queue):
 
     exp.reset_usage_counts(ignore_keys=['REP', 'RND_IDX', 'HOST',
                                         'Name', 'Desc', 'Repeat', 'Module',
-                                        'YamlLog']).freeze()
+                                        'YamlLog', 'ClearSolved']).freeze()
     try:
         t0 = time.time()
         exp.Run(exp)  # RUN MODULE
@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from callbacks import callbacks
+
+
+def test_required_interval_accepts_float_boundaries():
+    callback = callbacks.PiecewisePruningCallback([1e4, 2.5e4], [1.0, 0.5, 0.2])
+    assert callback.required_interval == 5000
+
+
+def test_required_interval_of_no_boundaries():
+    assert callbacks.get_required_interval([]) == 1
+
+
+def test_required_interval_rejects_fractional_boundaries():
+    with pytest.raises(ValueError):
+        callbacks.get_required_interval([100, 150.5])
@@ -0,0 +1,33 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from modules.pruning import device_pruning, pruning_utils
+
+
+@pytest.mark.parametrize("offset", [0.0, -2.0])
+@pytest.mark.parametrize("budget", [1.0, 0.7, 0.3, 0.0])
+def test_budget_masks_match_numpy_backend(budget, offset):
+    rng = np.random.default_rng(0)
+    saliences = {'a': rng.random((6, 5)).astype(np.float32) + offset,
+                 'b': rng.integers(0, 3, (3, 3, 4, 2)).astype(np.float32) + offset}
+    costs = {'a': 1.0, 'b': 9.0}
+
+    expected = pruning_utils.saliences2masks_budget(saliences, costs, budget)
+    masks = device_pruning.get_budget_masks([tf.constant(s) for s in saliences.values()],
+                                            tf.constant(list(costs.values()), tf.float64),
+                                            tf.constant(budget, tf.float64))
+    for key, mask in zip(saliences, masks):
+        np.testing.assert_array_equal(mask.numpy(), expected[key])
+
+
+def test_budget_costs_do_not_retrace():
+    kernels = [tf.Variable(tf.random.normal((4, 3))), tf.Variable(tf.random.normal((3, 2)))]
+    masks = [tf.Variable(tf.ones(k.shape, tf.bool)) for k in kernels]
+    traced = device_pruning.update_kernel_masks.experimental_get_tracing_count()
+    for costs in ([1.0, 2.0], [3.0, 5.0]):
+        device_pruning.update_kernel_masks(kernels, masks, tf.constant(0.5, tf.float64),
+                                           method='magnitude',
+                                           costs=tf.constant(costs, tf.float64))
+    assert device_pruning.update_kernel_masks.experimental_get_tracing_count() <= traced + 1
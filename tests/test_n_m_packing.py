@@ -0,0 +1,50 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from modules.pruning import n_m_packing, pruning_utils, sparse_layers
+
+
+@pytest.mark.parametrize("shape", [(10, 6), (3, 3, 10, 4), (8, 5)])
+@pytest.mark.parametrize("n_m", [(2, 4), (1, 4), (3, 8)])
+def test_pack_unpack_round_trip(shape, n_m):
+    n, m = n_m
+    kernel = np.random.default_rng(0).normal(size=shape).astype(np.float32)
+    mask = pruning_utils.get_n_m_mask(np.abs(kernel), n, m)
+    kernel = kernel * mask
+
+    values, positions = n_m_packing.pack_kernel(kernel, mask, n_m)
+    assert positions.dtype == np.uint8
+    assert values.shape[-1] == n
+
+    unpacked, unpacked_mask = n_m_packing.unpack_kernel(values, positions, shape, m)
+    np.testing.assert_array_equal(unpacked, kernel)
+    np.testing.assert_array_equal(unpacked_mask, mask)
+
+    tf_unpacked = sparse_layers.unpack_n_m(tf.constant(values), tf.constant(positions),
+                                           shape[-2], m)
+    np.testing.assert_array_equal(tf_unpacked.numpy(), kernel)
+
+
+@pytest.mark.parametrize("kernel_size", [None, (1, 1), (3, 3)])
+def test_packed_layers_match_dense(kernel_size):
+    n_m = (2, 4)
+    rng = np.random.default_rng(0)
+    shape = (10, 6) if kernel_size is None else (*kernel_size, 10, 6)
+    kernel = rng.normal(size=shape).astype(np.float32)
+    kernel = kernel * pruning_utils.get_n_m_mask(np.abs(kernel), *n_m)
+    weights = list(n_m_packing.pack_kernel(kernel, kernel != 0, n_m))
+
+    if kernel_size is None:
+        x = rng.normal(size=(4, 10)).astype(np.float32)
+        layer = sparse_layers.PackedNMDense(6, n_m, use_bias=False)
+        expected = x @ kernel
+    else:
+        x = rng.normal(size=(2, 7, 7, 10)).astype(np.float32)
+        layer = sparse_layers.PackedNMConv(6, n_m, kernel_size=kernel_size, strides=(2, 2),
+                                           padding='same', use_bias=False)
+        expected = tf.nn.conv2d(x, kernel, strides=2, padding='SAME').numpy()
+    layer.build(x.shape)
+    layer.set_weights(weights)
+    np.testing.assert_allclose(layer(x).numpy(), expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,65 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+
+from modules.pruning import pruning_utils
+
+
+def get_saliences(sizes, levels, seed=0):
+    """Saliences with many ties, `levels` distinct values."""
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, levels, size).astype(np.float32) for size in sizes]
+
+
+@pytest.mark.parametrize("sizes", [(30, 50, 20), (40000, 35000, 100)])
+@pytest.mark.parametrize("percentage", [0.0, 0.1, 0.5, 0.97, 1.0])
+def test_get_pruning_mask_prunes_exactly_k(sizes, percentage):
+    saliences = get_saliences(sizes, levels=7)
+    masks = pruning_utils.get_pruning_mask(saliences, percentage)
+
+    total = sum(sizes)
+    num_kept = sum(np.count_nonzero(m) for m in masks)
+    assert total - num_kept == pruning_utils.get_num_pruned(total, percentage)
+    assert all(m.dtype == bool and m.shape == s.shape for m, s in zip(masks, saliences))
+
+    pruned = np.concatenate([s[~m] for s, m in zip(saliences, masks)])
+    kept = np.concatenate([s[m] for s, m in zip(saliences, masks)])
+    if pruned.size and kept.size:
+        assert pruned.max() <= kept.min()
+
+
+def test_get_pruning_mask_breaks_ties_by_position():
+    saliences = [np.ones(4, dtype=np.float32), np.ones(4, dtype=np.float32)]
+    masks = pruning_utils.get_pruning_mask(saliences, 5 / 8)
+    assert masks[0].tolist() == [False] * 4
+    assert masks[1].tolist() == [False, True, True, True]
+
+
+def test_saliences2masks_many_matches_single_sparsity():
+    saliences = dict(zip("abc", get_saliences((30, 50, 20), levels=5)))
+    percentages = [0.2, 0.5, 0.9]
+    many = pruning_utils.saliences2masks_many(saliences, percentages)
+    assert not isinstance(many, list)
+
+    previous = None
+    for percentage, masks in zip(percentages, many):
+        expected = pruning_utils.saliences2masks(saliences, percentage)
+        for key in saliences:
+            assert masks[key].dtype == bool
+            np.testing.assert_array_equal(masks[key], expected[key])
+            if previous is not None:
+                assert not np.any(masks[key] & ~previous[key])
+        previous = masks
+
+
+def test_budget_prunes_expensive_weights_first_with_negative_saliences():
+    rng = np.random.default_rng(0)
+    # like GraSP, all saliences are negative and equally distributed in both layers
+    saliences = {'cheap': -rng.random(1000), 'expensive': -rng.random(1000)}
+    costs = {'cheap': 1.0, 'expensive': 10.0}
+
+    masks = pruning_utils.saliences2masks_budget(saliences, costs, budget=0.5)
+    assert masks['expensive'].mean() < masks['cheap'].mean()
+    remaining = sum(costs[key] * np.count_nonzero(m) for key, m in masks.items())
+    assert remaining <= 0.5 * sum(costs[key] * m.size for key, m in masks.items())
@@ -0,0 +1,78 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from modules.pruning import sparse_layers
+
+
+def get_model(units=8, inputs=16):
+    x = tf.keras.layers.Input((inputs,))
+    model = tf.keras.Model(x, sparse_layers.MaskedDense(units)(x))
+    optimizers = getattr(tf.keras.optimizers, 'legacy', tf.keras.optimizers)
+    model.compile(optimizers.SGD(0.1, momentum=0.9), 'mse')
+    return model
+
+
+def get_data(inputs=16, units=8):
+    rng = np.random.default_rng(0)
+    return (rng.normal(size=(64, inputs)).astype(np.float32),
+            rng.normal(size=(64, units)).astype(np.float32))
+
+
+def test_masked_gradients_keep_pruned_weights_at_zero(monkeypatch):
+    monkeypatch.setattr(sparse_layers.MaskedDense, 'mask_gradients', True)
+    model = get_model()
+    layer = model.layers[-1]
+    x, y = get_data()
+
+    # momentum of all weights is nonzero before the pruning
+    model.fit(x, y, batch_size=16, epochs=1, verbose=0)
+    mask = np.random.default_rng(1).random(layer.kernel.shape) > 0.5
+    layer.set_pruning_mask(mask)
+    layer.apply_pruning_mask(optimizer=model.optimizer)
+
+    model.fit(x, y, batch_size=16, epochs=2, verbose=0)
+    kernel = layer.kernel.numpy()
+    assert np.all(kernel[~mask] == 0)
+    assert np.all(kernel[mask] != 0)
+
+
+def test_nonzero_counters_follow_mask_updates():
+    from modules.pruning import device_pruning
+
+    model = get_model()
+    layer = model.layers[-1]
+    size = layer.kernel.shape.num_elements()
+    assert sparse_layers.count_nonzero([layer]).tolist() == [size]
+
+    mask = np.arange(size).reshape(layer.kernel.shape) % 4 == 0
+    layer.set_pruning_mask(mask)
+    assert layer.left_unpruned == np.count_nonzero(mask)
+
+    device_pruning.prune_l1(model, {'sparsity': 0.5}, silent=True)
+    assert sparse_layers.count_nonzero([layer]).tolist() == [size // 2]
+
+    layer.kernel_mask.assign(tf.ones_like(layer.kernel_mask))
+    sparse_layers.count_masks(model)
+    assert layer.sparsity == 0
+    assert len(layer.weights) == 3  # the counter isn't saved in checkpoints
+
+
+def test_nonzero_counters_follow_mask_helpers():
+    from modules.pruning import pruning_utils
+
+    model = get_model()
+    layer = model.layers[-1]
+    masks = pruning_utils.get_kernel_masks(model)
+
+    pruning_utils.set_kernel_masks_values(masks, 0)
+    assert layer.left_unpruned == 0
+
+    new_mask = tf.Variable(tf.ones_like(layer.kernel_mask))
+    pruning_utils.set_kernel_masks_object(model, [new_mask])
+    assert layer.left_unpruned == layer.kernel.shape.num_elements()
+
+    pruning_utils.set_kernel_masks_values([new_mask], [np.eye(*new_mask.shape)])
+    assert pruning_utils.report_density(model) == pytest.approx(
+        min(new_mask.shape) / layer.kernel.shape.num_elements())
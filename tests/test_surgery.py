@@ -0,0 +1,67 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from modules.pruning import pruning_utils, sparse_layers, surgery
+from modules.tf_helper import models
+
+
+@pytest.fixture
+def resnet(monkeypatch):
+    monkeypatch.setattr(tf.keras.layers, 'Conv2D', sparse_layers.MaskedConv)
+    monkeypatch.setattr(tf.keras.layers, 'Dense', sparse_layers.MaskedDense)
+    return models.ResNet(input_shape=(16, 16, 3),
+                         n_classes=5,
+                         group_sizes=(1, 1, 1),
+                         features=(8, 16, 16),
+                         head=(("conv", 8, 3, 1),),
+                         final_pooling="gempool")
+
+
+def prune_channels(model):
+    pruning_utils.prune_l1(model, {'sparsity': 0.5, 'structure': True}, silent=True)
+    # units of the classifier are pruned too, but outputs have to stay
+    classifier = model.layers[-1]
+    mask = classifier.kernel_mask.numpy()
+    mask[:, :2] = False
+    classifier.set_pruning_mask(mask)
+    pruning_utils.apply_pruning_for_model(model)
+
+
+@pytest.mark.parametrize("shift_bn", [False, True])
+def test_shrink_resnet_keeps_outputs(resnet, shift_bn):
+    rng = np.random.default_rng(0)
+    if shift_bn:
+        # pruned channels shifted by BatchNorm to a positive constant have to be kept
+        for layer in resnet.layers:
+            if isinstance(layer, tf.keras.layers.BatchNormalization):
+                size = layer.beta.shape[0]
+                layer.beta.assign(rng.normal(size=size).astype(np.float32))
+                layer.moving_mean.assign(rng.normal(size=size).astype(np.float32))
+    prune_channels(resnet)
+
+    shrunk = surgery.shrink_model(resnet, silent=True)
+    assert shrunk.output_shape == resnet.output_shape
+    assert shrunk.count_params() < resnet.count_params()
+    assert surgery.get_output_drift(resnet, shrunk) < 1e-4
+    assert any(isinstance(l, models.GemPool) for l in shrunk.layers)
+
+
+def test_shrink_removes_channels_zeroed_by_relu():
+    x = tf.keras.Input((8, 8, 3))
+    conv = sparse_layers.MaskedConv(4, 3, padding="same", use_bias=False)
+    bn = tf.keras.layers.BatchNormalization()
+    flow = tf.nn.relu(bn(conv(x)))
+    model = tf.keras.Model(x, sparse_layers.MaskedConv(2, 3, padding="same")(flow))
+
+    mask = conv.kernel_mask.numpy()
+    mask[..., :2] = False
+    conv.set_pruning_mask(mask)
+    pruning_utils.apply_pruning_for_model(model)
+    # the first pruned channel becomes a negative constant, the second a positive one
+    bn.beta.assign([-1.0, 1.0, 0.0, 0.0])
+
+    shrunk = surgery.shrink_model(model, silent=True)
+    assert shrunk.layers[1].filters == 3
+    assert surgery.get_output_drift(model, shrunk) < 1e-4
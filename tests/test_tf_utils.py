@@ -0,0 +1,28 @@
+import itertools
+
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from modules.tf_helper import tf_utils
+
+
+def run_timer(monkeypatch, durations, num_steps):
+    """Runs `StepTimer` over calls taking `durations` seconds, `num_steps` each."""
+    clock = itertools.accumulate([0.0] + [x for d in durations for x in (d, 0.0)])
+    monkeypatch.setattr(tf_utils.time, 'perf_counter', lambda: next(clock))
+
+    timer = tf_utils.StepTimer()
+    for batch, _ in enumerate(durations):
+        timer.on_train_batch_begin(batch * num_steps)
+        timer.on_train_batch_end(batch * num_steps, {'num_steps': num_steps})
+    return timer
+
+
+@pytest.mark.parametrize("num_steps", [1, 4])
+def test_compile_time_excludes_all_steps_of_the_first_call(monkeypatch, num_steps):
+    step = 0.5
+    durations = [10.0 + num_steps * step] + [num_steps * step] * 3
+    timer = run_timer(monkeypatch, durations, num_steps)
+    assert timer.step_time == pytest.approx(step)
+    assert timer.compile_time == pytest.approx(10.0)
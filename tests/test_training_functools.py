@@ -0,0 +1,63 @@
+import threading
+import types
+
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from modules.tf_helper import training_functools
+
+
+class RecordingPbar:
+    def __init__(self):
+        self.postfixes = []
+
+    def set_postfix(self, postfix, refresh=True):
+        self.postfixes.append((threading.get_ident(), postfix))
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_metrics_logger_shows_consistent_snapshots(background):
+    metrics = [tf.keras.metrics.Sum(name='a'), tf.keras.metrics.Sum(name='b')]
+    model = types.SimpleNamespace(metrics=metrics)
+    pbar = RecordingPbar()
+    logger = training_functools.MetricsLogger(model, pbar, interval=2,
+                                              background=background)
+    for step in range(20):
+        for metric in metrics:
+            metric.update_state(1.0)
+        logger.on_step_end(step, batch_size=4)
+    logger.close()
+
+    assert pbar.postfixes
+    for thread, postfix in pbar.postfixes:
+        assert thread == threading.get_ident()
+        assert postfix['a'] == postfix['b']
+        assert postfix['a'] % 2 == 0
+    if not background:
+        assert [p['a'] for _, p in pbar.postfixes] == list(range(2, 21, 2))
+
+
+class IntervalCallback(tf.keras.callbacks.Callback):
+    def __init__(self, required_interval):
+        super().__init__()
+        self.required_interval = required_interval
+
+    def on_train_batch_begin(self, batch, logs=None):
+        pass
+
+
+def test_steps_per_execution_keeps_boundaries_aligned_across_epochs():
+    steps = 100
+    callbacks = [IntervalCallback(40)]
+    num_steps = training_functools.get_steps_per_execution(30, callbacks, steps)
+
+    # global steps at which callbacks are called in the first epochs
+    starts = [epoch * steps + bidx for epoch in range(3)
+              for bidx in range(0, steps, num_steps)]
+    assert {40, 80, 120, 160, 200, 240}.issubset(starts)
+
+
+def test_steps_per_execution_without_batch_hooks():
+    callbacks = [tf.keras.callbacks.Callback(), IntervalCallback(0)]
+    assert training_functools.get_steps_per_execution(30, callbacks, 100) == 30
@@ -183,12 +183,53 @@ def load_python_object(path, scope={}):
                 raise e
 
 
+_solved_cache = {}
+
+
+def get_solved_cache_key(path, scope):
+    """Expression together with the values of all names it uses from the scope."""
+
+    try:
+        names = compile(path, '<solve_once>', 'eval').co_names
+    except SyntaxError:
+        names = ()
+    arguments = []
+    for name in sorted(set(names)):
+        if name in scope:
+            value = scope[name]
+            if isinstance(value, utils.Experiment):
+                value = value.todict()
+            arguments.append((name, repr(value)))
+    return path, tuple(arguments)
+
+
+def solve_python_object_once(path, scope={}):
+    key = get_solved_cache_key(path, scope)
+    if key in _solved_cache:
+        print(f"REUSING SOLVED {path}")
+    else:
+        _solved_cache[key] = load_python_object(path, scope=scope)
+    return _solved_cache[key]
+
+
+def clear_solved_cache(path=None):
+    """Forgets all objects solved with `solve_once` or only those solved from `path`."""
+
+    for key in list(_solved_cache):
+        if path is None or key[0] == path:
+            del _solved_cache[key]
+
+
 def solve_python_objects(exp, parent_scope={}):
     new_scope = copy(parent_scope)
     for key, value in exp.items():
         if isinstance(value, utils.Experiment):
             value = solve_python_objects(value, parent_scope=new_scope)
 
+        elif isinstance(value, str) and value.startswith('solve_once '):
+            value = value[11:].strip()
+            value = solve_python_object_once(value, scope=new_scope)
+
         elif isinstance(value, str) and value.startswith('solve '):
             value = value[6:].strip()
             value = load_python_object(value, scope=new_scope)